@@ -0,0 +1,156 @@
+"""Batched beam search for the Shakespeare char-RNN.
+
+At `temperature=0.01`, `extend_text` is greedy and soon loops ("i will not
+say 'tis not so i will be a word: ..."). Beam search instead keeps the
+`beam_width` most likely continuations of each prompt. All beams of all
+prompts live in one GRU state tensor of shape [n_prompts * beam_width,
+units]; after each step the surviving beams' states are reordered with a
+single `tf.gather`, and only back-pointers are kept, so the texts are rebuilt
+once at the end.
+
+A beam is finished when it generates one of `stop_chars` (none by default).
+Finished beams keep their score and compete with live ones through the
+length penalty `((5 + length) / 6) ** length_penalty` of Wu et al. (2016), and
+decoding stops early once every beam is finished.
+
+    decoder = BeamSearchDecoder(model, text_vec_layer)
+    decoder.decode(["To be, or not to be"], n_chars=100, beam_width=8)
+
+Run this file to benchmark beam-steps per second against the beam width.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from text_generation import StatefulGenerator
+
+
+def length_normalizer(lengths, alpha):
+    return ((5 + tf.cast(lengths, tf.float32)) / 6) ** alpha
+
+
+class BeamSearchDecoder:
+    def __init__(self, model, text_vec_layer):
+        self.generator = StatefulGenerator(model, text_vec_layer)
+        self.codec = self.generator.codec
+        self._step = tf.function(self._step)
+
+    def _step(self, probas, state, scores, lengths, finished, stop_mask,
+              alpha):
+        n_prompts, beam_width = tf.unstack(tf.shape(scores))
+        n_tokens = tf.shape(probas)[-1]
+        log_probas = tf.reshape(tf.math.log(probas),
+                                [n_prompts, beam_width, n_tokens])
+        # a finished beam has exactly one (dummy) continuation, at no cost
+        frozen = tf.math.log(tf.one_hot(0, n_tokens))
+        log_probas = tf.where(finished[..., tf.newaxis], frozen, log_probas)
+        candidates = scores[..., tf.newaxis] + log_probas
+        new_lengths = lengths + tf.cast(~finished, tf.int32)
+        normalized = candidates / length_normalizer(new_lengths, alpha)[
+            ..., tf.newaxis]
+        _, top = tf.math.top_k(tf.reshape(normalized, [n_prompts, -1]),
+                               k=beam_width)
+        beam_ids, char_ids = top // n_tokens, top % n_tokens
+        scores = tf.gather(tf.reshape(candidates, [n_prompts, -1]), top,
+                           batch_dims=1)
+        was_finished = tf.gather(finished, beam_ids, batch_dims=1)
+        lengths = tf.gather(new_lengths, beam_ids, batch_dims=1)
+        finished = was_finished | tf.gather(stop_mask, char_ids)
+        rows = tf.reshape(
+            tf.range(n_prompts)[:, tf.newaxis] * beam_width + beam_ids, [-1])
+        probas, state = self.generator.step_model(
+            [tf.reshape(char_ids, [-1, 1]), tf.gather(state, rows)])
+        return (probas[:, -1], state, scores, lengths, finished, beam_ids,
+                char_ids, was_finished)
+
+    def decode(self, prompts, n_chars=50, beam_width=4, length_penalty=0.6,
+               stop_chars="", return_all=False):
+        """Runs beam search for every prompt in `prompts` at once.
+
+        Returns, for each prompt, the extended prompt with the best
+        length-normalised score or, if `return_all` is True, the list of all
+        `(text, normalised log-probability)` pairs, best first.
+        """
+        prompts = list(prompts)
+        if not prompts:
+            return []
+        n_prompts = len(prompts)
+        probas, state = self.generator.feed_prompts(
+            *self.generator.encode_batch(prompts))
+        # every beam of a prompt starts identical: only beam 0 is live at
+        # first, so that the first step picks beam_width distinct characters
+        probas = tf.repeat(probas, beam_width, axis=0)
+        state = tf.repeat(state, beam_width, axis=0)
+        scores = tf.tile(
+            tf.constant([[0.0] + [-np.inf] * (beam_width - 1)]),
+            [n_prompts, 1])
+        lengths = tf.zeros([n_prompts, beam_width], tf.int32)
+        finished = tf.zeros([n_prompts, beam_width], tf.bool)
+        stop_mask = np.zeros(len(self.codec), bool)
+        stop_mask[self.codec.encode(stop_chars)] = True
+        stop_mask = tf.constant(stop_mask)
+        alpha = tf.constant(length_penalty, tf.float32)
+        history = []
+        for _ in range(n_chars):
+            (probas, state, scores, lengths, finished, beam_ids, char_ids,
+             was_finished) = self._step(probas, state, scores, lengths,
+                                        finished, stop_mask, alpha)
+            history.append((beam_ids.numpy(), char_ids.numpy(),
+                            was_finished.numpy()))
+            if stop_chars and finished.numpy().all():
+                break  # early stopping: nothing left to extend
+        normalized = scores / length_normalizer(lengths, alpha)
+        texts = self._backtrack(history, normalized.numpy(), prompts)
+        return texts if return_all else [beams[0][0] for beams in texts]
+
+    def _backtrack(self, history, normalized, prompts):
+        n_prompts, beam_width = normalized.shape
+        order = np.argsort(-normalized, axis=1)
+        rows = np.arange(n_prompts)[:, np.newaxis]
+        beams = order
+        char_ids = np.zeros([n_prompts, beam_width, len(history)], np.int32)
+        keep = np.zeros_like(char_ids, bool)
+        for t in reversed(range(len(history))):
+            beam_ids, step_char_ids, was_finished = history[t]
+            char_ids[:, :, t] = step_char_ids[rows, beams]
+            keep[:, :, t] = ~was_finished[rows, beams]
+            beams = beam_ids[rows, beams]
+        return [[(prompt + self.codec.decode(char_ids[p, b][keep[p, b]]),
+                  float(normalized[p, order[p, b]]))
+                 for b in range(beam_width)]
+                for p, prompt in enumerate(prompts)]
+
+
+def benchmark(decoder, prompts, beam_widths=(1, 2, 4, 8, 16), n_chars=100):
+    """Returns `{beam_width: beam-steps per second}` for `prompts`."""
+    results = {}
+    for beam_width in beam_widths:
+        decoder.decode(prompts, n_chars=2, beam_width=beam_width)  # trace
+        start = time.perf_counter()
+        decoder.decode(prompts, n_chars=n_chars, beam_width=beam_width)
+        elapsed = time.perf_counter() - start
+        results[beam_width] = len(prompts) * beam_width * n_chars / elapsed
+    return results
+
+
+if __name__ == "__main__":
+    from text_datasets import load_shakespeare
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model-dir", default="my_shakespeare_model")
+    parser.add_argument("--prompts", type=int, default=64)
+    parser.add_argument("--n-chars", type=int, default=100)
+    args = parser.parse_args()
+    text_vec_layer, _ = load_shakespeare()
+    decoder = BeamSearchDecoder(tf.keras.models.load_model(args.model_dir),
+                                text_vec_layer)
+    prompts = ["To be, or not to be", "The lady doth protest too much",
+               "Uneasy is the head that wears a crown"] * args.prompts
+    prompts = prompts[:args.prompts]
+    print(decoder.decode(prompts[:1], n_chars=args.n_chars, beam_width=8)[0])
+    for beam_width, rate in benchmark(decoder, prompts,
+                                      n_chars=args.n_chars).items():
+        print(f"beam width {beam_width:>3}: {rate:12.0f} beam-steps/s")
@@ -0,0 +1,239 @@
+"""Benchmark suite for the Shakespeare char-RNN code, with regression checks.
+
+Each suite times one path on its own:
+
+* `pipeline`: examples per second of `to_dataset` and `to_dataset_fast`;
+* `encoding`: characters per second encoded by `text_vec_layer` and by
+  `CharCodec`;
+* `training`: milliseconds per `train_on_batch` step of the GRU model;
+* `generation`: milliseconds per generated character of the notebook's
+  `extend_text` loop and of `StatefulGenerator`, for several prompt lengths
+  and batch sizes.
+
+Every measurement is the median of `--repeats` runs after a warm-up run.
+
+    python benchmarks.py run --output baseline.json
+    python benchmarks.py run --output new.json --compare baseline.json
+    python benchmarks.py compare baseline.json new.json --tolerance 0.1
+
+The results file is JSON: `{"environment": {...}, "results": {name: {"value",
+"unit", "higher_is_better"}}}`. `compare` lists every metric that got worse
+than the baseline by more than `tolerance` (a fraction) and exits with status
+1 if there is any, so the suite can gate a change.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+suites = ["pipeline", "encoding", "training", "generation"]
+
+
+def _median_time(run, repeats):
+    run()  # warm up (tracing, buffers)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def _result(value, unit, higher_is_better):
+    return {"value": round(value, 4), "unit": unit,
+            "higher_is_better": higher_is_better}
+
+
+def bench_pipeline(encoded, repeats, n_batches=200, length=100,
+                   batch_size=32):
+    from text_datasets import pipelines
+
+    results = {}
+    for name, to_dataset in pipelines.items():
+        ds = to_dataset(encoded[:1_000_000], length=length, shuffle=True,
+                        seed=42, batch_size=batch_size).repeat()
+        batches = iter(ds)
+        next(batches)  # fills the shuffle buffer
+
+        def run():
+            for _ in range(n_batches):
+                next(batches)
+
+        seconds = _median_time(run, repeats)
+        results[f"pipeline/{name}"] = _result(
+            n_batches * batch_size / seconds, "examples/s", True)
+    return results
+
+
+def bench_encoding(text_vec_layer, text, repeats, n_chars=100_000):
+    from char_codec import CharCodec
+
+    text = text[:n_chars]
+    codec = CharCodec.from_text_vec_layer(text_vec_layer)
+    cases = {"text_vec_layer": lambda: (text_vec_layer([text]) - 2).numpy(),
+             "CharCodec": lambda: codec.encode(text)}
+    return {f"encoding/{name}": _result(
+                len(text) / _median_time(case, repeats), "chars/s", True)
+            for name, case in cases.items()}
+
+
+def bench_training(encoded, n_tokens, repeats, length=100, batch_sizes=(32,),
+                   n_steps=20):
+    from char_rnn_model import build_model
+    from text_datasets import to_dataset_fast
+
+    results = {}
+    for batch_size in batch_sizes:
+        model = build_model(n_tokens)
+        batches = iter(to_dataset_fast(encoded[:1_000_000], length=length,
+                                       shuffle=True, seed=42,
+                                       batch_size=batch_size).repeat())
+        X, Y = next(batches)
+
+        def run():
+            for _ in range(n_steps):
+                model.train_on_batch(X, Y)
+
+        results[f"training/step, batch {batch_size}"] = _result(
+            _median_time(run, repeats) / n_steps * 1e3, "ms/step", False)
+    return results
+
+
+def bench_generation(model, text_vec_layer, text, repeats,
+                     prompt_lengths=(20, 100, 400), batch_sizes=(1, 32),
+                     n_chars=50, n_reference_chars=5):
+    from text_generation import (StatefulGenerator, make_shakespeare_model,
+                                 reference_extend_text)
+
+    results = {}
+    shakespeare_model = make_shakespeare_model(model, text_vec_layer)
+    generator = StatefulGenerator(model, text_vec_layer)
+    for prompt_length in prompt_lengths:
+        prompt = text[:prompt_length]
+        seconds = _median_time(lambda: reference_extend_text(
+            shakespeare_model, text_vec_layer, prompt, n_reference_chars),
+            repeats)
+        results[f"generation/notebook extend_text, prompt {prompt_length}, "
+                f"batch 1"] = _result(seconds / n_reference_chars * 1e3,
+                                      "ms/char", False)
+        for batch_size in batch_sizes:
+            prompts = [prompt] * batch_size
+            seconds = _median_time(
+                lambda: generator.generate(prompts, n_chars=n_chars), repeats)
+            results[f"generation/StatefulGenerator, prompt {prompt_length}, "
+                    f"batch {batch_size}"] = _result(
+                seconds / n_chars * 1e3, "ms/char", False)
+    return results
+
+
+def environment():
+    import tensorflow as tf
+
+    return {"python": platform.python_version(), "tensorflow": tf.__version__,
+            "machine": platform.machine(), "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def run_suites(selected=suites, model_dir="my_shakespeare_model", repeats=5):
+    """Runs the `selected` suites and returns the results document."""
+    import tensorflow as tf
+
+    from char_rnn_model import build_model
+    from text_datasets import load_shakespeare, shakespeare_url
+
+    filepath = tf.keras.utils.get_file("shakespeare.txt", shakespeare_url)
+    with open(filepath) as f:
+        text = f.read()
+    text_vec_layer, encoded = load_shakespeare()
+    n_tokens = text_vec_layer.vocabulary_size() - 2
+    results = {}
+    if "pipeline" in selected:
+        results.update(bench_pipeline(encoded, repeats))
+    if "encoding" in selected:
+        results.update(bench_encoding(text_vec_layer, text, repeats))
+    if "training" in selected:
+        results.update(bench_training(encoded, n_tokens, repeats))
+    if "generation" in selected:
+        # latency does not depend on the weights, so an untrained model will
+        # do when the trained one is not there
+        model = (tf.keras.models.load_model(model_dir)
+                 if os.path.isdir(model_dir) else build_model(n_tokens))
+        results.update(bench_generation(model, text_vec_layer, text, repeats))
+    return {"environment": environment(), "results": results}
+
+
+def compare(baseline, current, tolerance=0.1):
+    """Returns the metrics of `current` that regressed against `baseline`.
+
+    Each regression is `(name, baseline_value, current_value, change)`,
+    where `change` is the relative change in the bad direction. Metrics
+    missing from either document are ignored.
+    """
+    regressions = []
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        old, new = baseline["results"][name]["value"], result["value"]
+        if old == 0:
+            continue
+        change = (old - new) / old if result["higher_is_better"] else (
+            (new - old) / old)
+        if change > tolerance:
+            regressions.append((name, old, new, change))
+    return regressions
+
+
+def report(baseline, current, tolerance):
+    regressions = compare(baseline, current, tolerance)
+    for name, old, new, change in regressions:
+        unit = current["results"][name]["unit"]
+        print(f"REGRESSION {name}: {old:,.2f} -> {new:,.2f} {unit} "
+              f"({change:+.1%} worse)")
+    if not regressions:
+        print(f"no regressions beyond {tolerance:.0%}")
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument("--suites", nargs="+", choices=suites,
+                            default=suites)
+    run_parser.add_argument("--model-dir", default="my_shakespeare_model")
+    run_parser.add_argument("--repeats", type=int, default=5)
+    run_parser.add_argument("--output", help="write the results here")
+    run_parser.add_argument("--compare", metavar="BASELINE",
+                            help="check the results against this file")
+    compare_parser = subparsers.add_parser("compare")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    for subparser in (run_parser, compare_parser):
+        subparser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        return report(baseline, current, args.tolerance)
+    current = run_suites(args.suites, args.model_dir, args.repeats)
+    for name, result in current["results"].items():
+        print(f"{name:>60}: {result['value']:>14,.2f} {result['unit']}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            return report(json.load(f), current, args.tolerance)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+"""Byte-pair-encoding (BPE) subword tokenizer for the char-RNN.
+
+With `TextVectorization(split="character")`, a 100-step training window
+covers 100 characters of text, and generating 100 characters takes 100 GRU
+steps. `BPETokenizer` starts from the same characters and adds one token per
+merge of the most frequent adjacent pair of tokens, so frequent character
+sequences ("the ", "ing") become single tokens and every GRU step covers
+several characters.
+
+`BPETokenizer.train` counts all adjacent pairs once, then keeps the counts
+up to date as it merges: the text is a doubly linked list of tokens, each
+pair remembers where it occurs, and a merge only touches the neighbours of
+the merged occurrences. The next pair to merge is taken from a max-heap of
+counts, whose outdated entries are skipped when they reach the top. No merge
+rescans the corpus.
+
+A tokenizer has the same interface as `CharCodec` (`encode`, `encode_batch`,
+`decode`, `decode_batch`, `len()`), so it can replace `text_vec_layer`
+wherever the IDs come from a codec:
+
+    tokenizer = BPETokenizer.train(shakespeare_text, vocab_size=256)
+    encoded = tokenizer.encode(shakespeare_text)
+    train_set = to_dataset(encoded[:1_000_000], length=100, shuffle=True)
+    model = build_model(len(tokenizer))
+    ...
+    generator = StatefulGenerator(model, tokenizer)  # n_chars counts tokens
+
+Encoding applies the merges in training order to a whole array of
+character IDs at once with NumPy, one vectorised pass per merge; batches
+are encoded as a single array, with a separator between texts that no merge
+can cross.
+
+    python bpe_tokenizer.py --vocab-size 256 --output shakespeare_bpe.json
+"""
+
+import argparse
+import heapq
+import json
+import time
+
+import numpy as np
+
+from char_codec import CharCodec
+
+_separator = -1  # between the texts of a batch; never part of a pair
+
+
+def _apply_merge(token_ids, left, right, new_id):
+    """Replaces the non-overlapping (left, right) pairs, leftmost first."""
+    starts = np.flatnonzero((token_ids[:-1] == left)
+                            & (token_ids[1:] == right))
+    if starts.size == 0:
+        return token_ids
+    if left == right:  # in a run like "aaa", only every other pair merges
+        run_start = np.concatenate([[True], np.diff(starts) != 1])
+        run_index = np.maximum.accumulate(
+            np.where(run_start, np.arange(starts.size), 0))
+        starts = starts[(np.arange(starts.size) - run_index) % 2 == 0]
+    token_ids = token_ids.copy()
+    token_ids[starts] = new_id
+    return np.delete(token_ids, starts + 1)
+
+
+class BPETokenizer:
+    def __init__(self, alphabet, merges):
+        """`alphabet` lists the characters (IDs 0 to len - 1), and `merges`
+        the (left, right) ID pairs merged into IDs len(alphabet), ..."""
+        self.codec = CharCodec(alphabet)
+        self.merges = [tuple(merge) for merge in merges]
+        self.vocabulary = list(self.codec.vocabulary)
+        for left, right in self.merges:
+            self.vocabulary.append(self.vocabulary[left]
+                                   + self.vocabulary[right])
+        self._strings = np.array(self.vocabulary, dtype=object)
+
+    @classmethod
+    def train(cls, text, vocab_size=256, alphabet=None, min_count=2):
+        """Learns merges on `text` until there are `vocab_size` tokens.
+
+        `alphabet` defaults to the characters of `text`, most frequent
+        first; pass `text_vec_layer.get_vocabulary()[2:]` to keep the
+        notebook's character IDs. Training stops early when no pair occurs
+        `min_count` times.
+        """
+        if alphabet is None:  # lowercased like standardize="lower"
+            code_points = np.frombuffer(text.encode("utf-32-le"), np.uint32)
+            upper = (code_points >= ord("A")) & (code_points <= ord("Z"))
+            code_points, counts = np.unique(
+                np.where(upper, code_points + 32, code_points),
+                return_counts=True)
+            alphabet = [chr(code_point) for code_point in
+                        code_points[np.argsort(-counts, kind="stable")]]
+        token_ids = CharCodec(alphabet).encode(text).tolist()
+        n = len(token_ids)
+        if n == 0:
+            raise ValueError("text must contain at least one character")
+        prev_pos = list(range(-1, n - 1))
+        next_pos = list(range(1, n + 1))
+        next_pos[-1] = -1
+        pair_counts, pair_positions = {}, {}
+        for i in range(n - 1):
+            pair = (token_ids[i], token_ids[i + 1])
+            pair_counts[pair] = pair_counts.get(pair, 0) + 1
+            pair_positions.setdefault(pair, []).append(i)
+        heap = [(-count, pair) for pair, count in pair_counts.items()]
+        heapq.heapify(heap)
+
+        def add(pair, position, delta):
+            pair_counts[pair] = pair_counts.get(pair, 0) + delta
+            if delta > 0:
+                pair_positions.setdefault(pair, []).append(position)
+            changed.add(pair)
+
+        merges = []
+        while len(alphabet) + len(merges) < vocab_size and heap:
+            neg_count, pair = heapq.heappop(heap)
+            if -neg_count != pair_counts.get(pair, 0):
+                continue  # outdated heap entry
+            if -neg_count < min_count:
+                break
+            left, right = pair
+            new_id = len(alphabet) + len(merges)
+            merges.append(pair)
+            changed = set()
+            for i in sorted(set(pair_positions.pop(pair))):
+                j = next_pos[i]
+                if token_ids[i] != left or j < 0 or token_ids[j] != right:
+                    continue  # merged or changed since it was recorded
+                p, q = prev_pos[i], next_pos[j]
+                add(pair, i, -1)
+                if p >= 0:
+                    add((token_ids[p], left), p, -1)
+                    add((token_ids[p], new_id), p, +1)
+                if q >= 0:
+                    add((right, token_ids[q]), j, -1)
+                    add((new_id, token_ids[q]), i, +1)
+                    prev_pos[q] = i
+                token_ids[i], token_ids[j] = new_id, _separator
+                next_pos[i] = q
+            for changed_pair in changed:
+                count = pair_counts[changed_pair]
+                if count > 0:
+                    heapq.heappush(heap, (-count, changed_pair))
+                else:
+                    del pair_counts[changed_pair]
+                    pair_positions.pop(changed_pair, None)
+        return cls(alphabet, merges)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            config = json.load(f)
+        return cls(config["alphabet"], config["merges"])
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"alphabet": self.codec.vocabulary,
+                       "merges": self.merges}, f)
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+    def _merge_all(self, token_ids):
+        for new_id, (left, right) in enumerate(self.merges, len(self.codec)):
+            token_ids = _apply_merge(token_ids, left, right, new_id)
+        return token_ids
+
+    def encode(self, text, skip_unknown=False):
+        """Returns the token IDs of `text` as an int32 array."""
+        return self._merge_all(self.codec.encode(text, skip_unknown))
+
+    def encode_batch(self, texts, pad_id=-2):
+        """Encodes `texts` into one array padded with `pad_id`.
+
+        Returns the array, shape [len(texts), most tokens], and the list of
+        token counts.
+        """
+        texts = list(texts)
+        joined = np.full(sum(len(text) + 1 for text in texts), _separator,
+                         np.int32)
+        is_char = np.ones(len(joined), bool)
+        is_char[np.cumsum([len(text) + 1 for text in texts],
+                          dtype=np.int64) - 1] = False
+        joined[is_char] = self.codec.encode("".join(texts))
+        token_ids = self._merge_all(joined)
+        ends = np.flatnonzero(token_ids == _separator)
+        starts = np.concatenate([[0], ends[:-1] + 1])
+        lengths = (ends - starts).tolist()
+        batch = np.full([len(texts), max(lengths, default=0)], pad_id,
+                        np.int32)
+        batch[np.arange(batch.shape[1]) < np.c_[lengths]] = (
+            token_ids[token_ids != _separator])
+        return batch, lengths
+
+    def decode(self, token_ids):
+        return "".join(self._strings[np.asarray(token_ids, np.int64)])
+
+    def decode_batch(self, token_ids):
+        """Decodes a [batch, steps] array of IDs into a list of strings."""
+        return [self.decode(row) for row in np.asarray(token_ids)]
+
+
+def main(argv=None):
+    import tensorflow as tf
+
+    from text_datasets import shakespeare_url
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vocab-size", type=int, default=256)
+    parser.add_argument("--output", help="save the tokenizer here")
+    args = parser.parse_args(argv)
+
+    filepath = tf.keras.utils.get_file("shakespeare.txt", shakespeare_url)
+    with open(filepath) as f:
+        text = f.read()
+    start = time.perf_counter()
+    tokenizer = BPETokenizer.train(text[:1_000_000], args.vocab_size)
+    print(f"trained {len(tokenizer.merges)} merges in "
+          f"{time.perf_counter() - start:.1f}s")
+    start = time.perf_counter()
+    encoded = tokenizer.encode(text)
+    encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    decoded = tokenizer.decode(encoded)
+    decode_time = time.perf_counter() - start
+    assert decoded == tokenizer.codec.decode(tokenizer.codec.encode(text))
+    print(f"{len(text) / len(encoded):.2f} characters per token: a 100-step "
+          f"window covers {100 * len(text) / len(encoded):.0f} characters")
+    print(f"encode {len(text) / encode_time / 1e6:.2f}M chars/s, decode "
+          f"{len(text) / decode_time / 1e6:.2f}M chars/s")
+    if args.output:
+        tokenizer.save(args.output)
+
+
+if __name__ == "__main__":
+    main()
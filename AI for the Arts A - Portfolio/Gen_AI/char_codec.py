@@ -0,0 +1,138 @@
+"""Fast character encoding and decoding for the Shakespeare char-RNN.
+
+The notebook's `next_char` calls `text_vec_layer.get_vocabulary()` for every
+generated character, which rebuilds a Python list of the whole vocabulary
+each time, and `shakespeare_model` runs the `TextVectorization` layer and a
+`Lambda(X - 2)` on every call. `CharCodec` is built once from the adapted
+vocabulary and uses two lookup arrays instead: Unicode code point -> model ID
+for encoding, and model ID -> code point for decoding, so a whole batch of
+ID sequences is turned into strings with one NumPy gather and one UTF-32
+decode.
+
+IDs are the notebook's shifted IDs (`text_vec_layer` output minus 2), and
+encoding lowercases ASCII letters only, as `standardize="lower"` does.
+
+Run this file for microbenchmarks against the `TextVectorization` path.
+"""
+
+import timeit
+
+import numpy as np
+
+
+class CharCodec:
+    def __init__(self, vocabulary):
+        """`vocabulary` lists the characters in model ID order, i.e.
+        `text_vec_layer.get_vocabulary()[2:]`."""
+        self.vocabulary = [str(char) for char in vocabulary]
+        if any(len(char) != 1 for char in self.vocabulary):
+            raise ValueError("every vocabulary entry must be one character")
+        self.code_points = np.array([ord(char) for char in self.vocabulary],
+                                    np.uint32)
+        # the last entry is always -1, for code points beyond the vocabulary
+        table_size = max(int(self.code_points.max(initial=0)) + 2, 128)
+        self.encode_table = np.full(table_size, -1, np.int32)
+        self.encode_table[self.code_points] = np.arange(len(self.vocabulary))
+        upper = np.arange(ord("A"), ord("Z") + 1)
+        self.encode_table[upper] = self.encode_table[upper + 32]
+
+    @classmethod
+    def from_text_vec_layer(cls, text_vec_layer):
+        return cls(text_vec_layer.get_vocabulary()[2:])
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+    def encode(self, text, skip_unknown=False):
+        """Returns the IDs of the characters of `text` as an int32 array.
+
+        Characters outside the vocabulary raise a ValueError, or are dropped
+        if `skip_unknown` is True.
+        """
+        code_points = np.frombuffer(text.encode("utf-32-le"), np.uint32)
+        char_ids = self.encode_table[
+            np.minimum(code_points, len(self.encode_table) - 1)]
+        unknown = np.flatnonzero(char_ids < 0)
+        if unknown.size:
+            if skip_unknown:
+                return char_ids[char_ids >= 0]
+            raise ValueError(f"unknown character {text[unknown[0]]!r}")
+        return char_ids
+
+    def encode_batch(self, texts, pad_id=-2):
+        """Encodes `texts` into one array padded with `pad_id`.
+
+        Returns the array, shape [len(texts), longest text], and the list of
+        text lengths.
+        """
+        texts = list(texts)
+        lengths = [len(text) for text in texts]
+        char_ids = np.full([len(texts), max(lengths, default=0)], pad_id,
+                           np.int32)
+        char_ids[np.arange(char_ids.shape[1]) < np.c_[lengths]] = (
+            self.encode("".join(texts)))
+        return char_ids, lengths
+
+    def decode(self, char_ids):
+        return self.code_points[np.asarray(char_ids)].tobytes().decode(
+            "utf-32-le")
+
+    def decode_batch(self, char_ids):
+        """Decodes a [batch, steps] array of IDs into a list of strings."""
+        char_ids = np.asarray(char_ids)
+        text = self.decode(char_ids.ravel())
+        n_steps = char_ids.shape[-1]
+        if n_steps == 0:
+            return [""] * len(char_ids)
+        return [text[start:start + n_steps]
+                for start in range(0, len(text), n_steps)]
+
+
+def as_codec(text_vec_layer):
+    """Returns a `CharCodec` for an adapted `TextVectorization` layer.
+
+    Objects that already encode and decode like a codec (e.g. a
+    `bpe_tokenizer.BPETokenizer`) are returned unchanged.
+    """
+    if hasattr(text_vec_layer, "encode_batch"):
+        return text_vec_layer
+    return CharCodec.from_text_vec_layer(text_vec_layer)
+
+
+def benchmark(text_vec_layer, text="To be, or not to be", batch_size=256,
+              n_steps=100, number=200):
+    """Times `CharCodec` against the notebook's `TextVectorization` path.
+
+    Returns microseconds per call for each operation.
+    """
+    import tensorflow as tf
+
+    codec = CharCodec.from_text_vec_layer(text_vec_layer)
+    char_ids = np.random.default_rng(42).integers(
+        len(codec), size=[batch_size, n_steps])
+    prompts = [text] * batch_size
+    vocabulary = tf.constant(codec.vocabulary)
+    cases = {
+        "decode 1 char, get_vocabulary()":
+            lambda: text_vec_layer.get_vocabulary()[int(char_ids[0, 0]) + 2],
+        "decode 1 char, CharCodec": lambda: codec.decode(char_ids[0, :1]),
+        "decode batch, tf.gather + reduce_join": lambda: tf.strings.reduce_join(
+            tf.gather(vocabulary, char_ids), axis=-1).numpy(),
+        "decode batch, CharCodec": lambda: codec.decode_batch(char_ids),
+        "encode 1 prompt, text_vec_layer - 2":
+            lambda: (text_vec_layer([text]) - 2).numpy(),
+        "encode 1 prompt, CharCodec": lambda: codec.encode(text),
+        "encode batch, text_vec_layer - 2":
+            lambda: (text_vec_layer(prompts) - 2).numpy(),
+        "encode batch, CharCodec": lambda: codec.encode_batch(prompts),
+    }
+    return {name: timeit.timeit(case, number=number) / number * 1e6
+            for name, case in cases.items()}
+
+
+if __name__ == "__main__":
+    from text_datasets import load_shakespeare
+
+    text_vec_layer, _ = load_shakespeare()
+    for name, micros in benchmark(text_vec_layer).items():
+        print(f"{name:>40}: {micros:10.1f} µs")
@@ -0,0 +1,32 @@
+"""The notebook's char-RNN, as a function, for scripts that train it.
+
+`build_model()` with its defaults is the notebook's `model`: Embedding(16),
+GRU(128) and a softmax Dense layer over the `n_tokens` characters, compiled
+with the same loss, optimizer and metrics.
+"""
+
+import tensorflow as tf
+
+
+def build_model(n_tokens, embed_dim=16, units=128, batch_size=None,
+                stateful=False):
+    """Returns the compiled char-RNN.
+
+    `batch_size` must be given when `stateful` is True, since a stateful GRU
+    keeps one hidden state per row of a fixed-size batch.
+    """
+    model = tf.keras.Sequential([
+        tf.keras.layers.Embedding(input_dim=n_tokens, output_dim=embed_dim,
+                                  batch_input_shape=[batch_size, None]),
+        tf.keras.layers.GRU(units, return_sequences=True, stateful=stateful),
+        tf.keras.layers.Dense(n_tokens, activation="softmax")
+    ])
+    model.compile(loss="sparse_categorical_crossentropy", optimizer="nadam",
+                  metrics=["accuracy"])
+    return model
+
+
+def model_dims(model):
+    """Returns `(n_tokens, embed_dim, units)` of a trained char-RNN."""
+    embedding, gru, _ = model.layers
+    return embedding.input_dim, embedding.output_dim, gru.units
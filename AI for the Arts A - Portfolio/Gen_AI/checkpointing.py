@@ -0,0 +1,280 @@
+"""Asynchronous weights-only checkpoints with mid-epoch resume.
+
+The notebook's `ModelCheckpoint("my_shakespeare_model", save_best_only=True)`
+writes a full SavedModel, graph included, on the training thread, and a crash
+in the middle of an epoch loses the whole epoch. `AsyncCheckpoint` instead
+copies the model weights, the optimizer state and the input-pipeline
+position (epoch and batch) into NumPy arrays every `every_n_steps` steps and
+hands them to a background thread, which writes them as an `.npz` file
+(atomically: to a temporary file, then renamed) and deletes all but the last
+`keep` snapshots. If the writer is still busy, a newer snapshot replaces the
+pending one rather than stalling training.
+
+`train` uses it with `to_dataset_fast`, reshuffling every epoch with
+`seed + epoch`, so that a restart restores the weights and optimizer and then
+skips exactly the batches already seen in the interrupted epoch. The serving
+SavedModel is only written when asked, by `export_saved_model`.
+
+    python checkpointing.py train --dir checkpoints --every 500 --epochs 10
+    python checkpointing.py export --dir checkpoints --best \\
+        --output my_shakespeare_model
+"""
+
+import argparse
+import glob
+import json
+import os
+import re
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+from text_datasets import load_shakespeare, to_dataset_fast
+
+
+def optimizer_variables(optimizer):
+    variables = optimizer.variables
+    return variables() if callable(variables) else variables
+
+
+def snapshot(model, **meta):
+    """Copies the model and optimizer state into NumPy arrays."""
+    arrays = {f"model/{i}": weight
+              for i, weight in enumerate(model.get_weights())}
+    arrays.update({f"optimizer/{i}": variable.numpy() for i, variable
+                   in enumerate(optimizer_variables(model.optimizer))})
+    arrays["meta"] = np.array(json.dumps(meta))
+    return arrays
+
+
+def write_atomically(path, arrays):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _step_of(path):
+    return int(re.search(r"ckpt-(\d+)\.npz$", path).group(1))
+
+
+def list_checkpoints(checkpoint_dir):
+    """Returns the step checkpoints in `checkpoint_dir`, oldest first."""
+    return sorted(glob.glob(os.path.join(checkpoint_dir, "ckpt-*.npz")),
+                  key=_step_of)
+
+
+def restore(model, path):
+    """Loads a snapshot into `model` (compiled); returns its metadata."""
+    with np.load(path) as arrays:
+        n_weights = len([key for key in arrays.files
+                         if key.startswith("model/")])
+        model.set_weights([arrays[f"model/{i}"] for i in range(n_weights)])
+        optimizer_keys = [key for key in arrays.files
+                          if key.startswith("optimizer/")]
+        if optimizer_keys:
+            model.optimizer.build(model.trainable_variables)  # make slots
+            for i, variable in enumerate(
+                    optimizer_variables(model.optimizer)):
+                variable.assign(arrays[f"optimizer/{i}"])
+        return json.loads(str(arrays["meta"]))
+
+
+class AsyncCheckpoint(tf.keras.callbacks.Callback):
+    """Snapshots training state every `every_n_steps` steps, off-thread.
+
+    `epoch` and `first_batch` tell the callback where in the data the
+    current `fit` call starts, so snapshots record the exact position; a
+    snapshot is also taken at the end of every epoch. If `monitor` is given,
+    the weights are also saved to `best.npz` whenever that logged metric
+    improves at the end of an epoch.
+
+    A failed write (disk full, permission denied...) does not stop the
+    writer: the error is kept in `error` and raised by the next `save`,
+    `flush` or `close`, so training does not go on without checkpoints.
+    """
+
+    def __init__(self, checkpoint_dir, every_n_steps=500, keep=3,
+                 monitor=None, mode="max", global_step=0, best=None):
+        super().__init__()
+        self.checkpoint_dir = checkpoint_dir
+        self.every_n_steps = every_n_steps
+        self.keep = keep
+        self.monitor = monitor
+        self.better = np.greater if mode == "max" else np.less
+        self.best = best
+        self.global_step = global_step
+        self.epoch = self.first_batch = 0
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        # at most one unwritten snapshot per kind ("step" or "best"): a newer
+        # one replaces it instead of making training wait for the disk
+        self.pending = {}
+        self.writing = False
+        self.closed = False
+        self.error = None  # the first failed write not yet raised
+        self.condition = threading.Condition()
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def _write_loop(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or self.closed)
+                if not self.pending:
+                    return
+                kind = next(iter(self.pending))
+                path, arrays = self.pending.pop(kind)
+                self.writing = True
+            error = None
+            try:
+                write_atomically(path, arrays)
+                if kind == "step":
+                    for old_path in list_checkpoints(
+                            self.checkpoint_dir)[:-self.keep]:
+                        try:
+                            os.remove(old_path)
+                        except FileNotFoundError:
+                            pass  # already removed
+            except Exception as write_error:  # keep the writer running
+                error = write_error
+            with self.condition:
+                self.writing = False
+                if error is not None and self.error is None:
+                    self.error = error
+                self.condition.notify_all()
+
+    def _raise_error(self):
+        """Raises the pending write error, if any (call with the lock)."""
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def _submit(self, kind, path, arrays):
+        with self.condition:
+            self._raise_error()
+            self.pending[kind] = (path, arrays)
+            self.condition.notify_all()
+
+    def save(self, epoch, batch_in_epoch):
+        """Snapshots the state reached after `batch_in_epoch` batches."""
+        path = os.path.join(self.checkpoint_dir,
+                            f"ckpt-{self.global_step}.npz")
+        self._submit("step", path, snapshot(
+            self.model, epoch=epoch, batch=batch_in_epoch,
+            global_step=self.global_step, best=self.best))
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.global_step += 1
+        if self.global_step % self.every_n_steps == 0:
+            self.save(self.epoch, self.first_batch + batch + 1)
+
+    def on_epoch_end(self, epoch, logs=None):
+        value = (logs or {}).get(self.monitor)
+        if value is not None and (self.best is None
+                                  or self.better(value, self.best)):
+            self.best = float(value)
+            self._submit("best", os.path.join(self.checkpoint_dir, "best.npz"),
+                         snapshot(self.model, epoch=self.epoch,
+                                  global_step=self.global_step,
+                                  **{self.monitor: self.best}))
+        self.save(self.epoch + 1, 0)
+
+    def flush(self):
+        """Blocks until every submitted snapshot is on disk."""
+        with self.condition:
+            self.condition.wait_for(
+                lambda: not self.pending and not self.writing)
+            self._raise_error()
+
+    def close(self):
+        """Writes the pending snapshots and stops the writer thread."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.writer.join()
+        with self.condition:
+            self._raise_error()
+
+
+def train(model, train_text, valid_set, checkpoint_dir, epochs=10, length=100,
+          batch_size=32, seed=42, every_n_steps=500, keep=3):
+    """Trains `model`, resuming from the latest snapshot if there is one.
+
+    Epoch `e` shuffles the training windows with `seed + e`, so the batches
+    of an interrupted epoch are the same after the restart and the ones
+    already trained on are skipped.
+    """
+    epoch, batch, global_step, best = 0, 0, 0, None
+    checkpoints = list_checkpoints(checkpoint_dir)
+    if checkpoints:
+        meta = restore(model, checkpoints[-1])
+        epoch, batch = meta["epoch"], meta["batch"]
+        global_step, best = meta["global_step"], meta["best"]
+        print(f"resuming at epoch {epoch + 1}, batch {batch}")
+    checkpoint = AsyncCheckpoint(checkpoint_dir, every_n_steps, keep,
+                                 monitor="val_accuracy",
+                                 global_step=global_step, best=best)
+    try:
+        for checkpoint.epoch in range(epoch, epochs):
+            checkpoint.first_batch = batch
+            train_set = to_dataset_fast(train_text, length=length,
+                                        shuffle=True,
+                                        seed=seed + checkpoint.epoch,
+                                        batch_size=batch_size,
+                                        skip_batches=batch)
+            print(f"Epoch {checkpoint.epoch + 1}/{epochs}")
+            model.fit(train_set, validation_data=valid_set,
+                      callbacks=[checkpoint])
+            batch = 0
+    finally:
+        checkpoint.close()
+    return model
+
+
+def export_saved_model(model, checkpoint_path, export_dir):
+    """Loads the weights in `checkpoint_path` and saves a serving SavedModel.
+
+    The result loads with `tf.keras.models.load_model`, like the notebook's
+    `my_shakespeare_model`.
+    """
+    with np.load(checkpoint_path) as arrays:
+        n_weights = len([key for key in arrays.files
+                         if key.startswith("model/")])
+        model.set_weights([arrays[f"model/{i}"] for i in range(n_weights)])
+    model.save(export_dir)
+
+
+def main(argv=None):
+    from char_rnn_model import build_model
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    train_parser = subparsers.add_parser("train")
+    train_parser.add_argument("--epochs", type=int, default=10)
+    train_parser.add_argument("--every", type=int, default=500)
+    train_parser.add_argument("--keep", type=int, default=3)
+    export_parser = subparsers.add_parser("export")
+    export_parser.add_argument("--output", default="my_shakespeare_model")
+    export_parser.add_argument("--best", action="store_true",
+                               help="export best.npz, not the latest step")
+    for subparser in (train_parser, export_parser):
+        subparser.add_argument("--dir", default="checkpoints")
+    args = parser.parse_args(argv)
+
+    text_vec_layer, encoded = load_shakespeare()
+    model = build_model(text_vec_layer.vocabulary_size() - 2)
+    if args.command == "train":
+        valid_set = to_dataset_fast(encoded[1_000_000:1_060_000], length=100)
+        train(model, encoded[:1_000_000], valid_set, args.dir, args.epochs,
+              every_n_steps=args.every, keep=args.keep)
+    else:
+        path = (os.path.join(args.dir, "best.npz") if args.best
+                else list_checkpoints(args.dir)[-1])
+        export_saved_model(model, path, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""Generation compiled into one XLA graph per call.
+
+Even `StatefulGenerator` makes one round trip from Python to TensorFlow per
+generated character. `CompiledGenerator` runs the whole step-and-sample loop
+in a `tf.while_loop` inside a `tf.function(jit_compile=True)`: the GRU cell,
+the output layer and Gumbel-max sampling are fused by XLA, and characters are
+written into a fixed-size [batch_size, max_chars] output buffer, so a batch of
+prompts costs one Python call however many characters it generates.
+
+Shapes are fixed (prompts are processed in batches of `batch_size`, padding
+the last one), so XLA compiles the loop once per generator.
+
+    generator = CompiledGenerator(model, text_vec_layer, batch_size=32)
+    generator.generate(["To be, or not to be"], n_chars=200, temperatures=0.5)
+
+Run this file to compare per-character latency on CPU with the eager loops.
+"""
+
+import argparse
+import time
+
+import tensorflow as tf
+
+from sampling import gumbel_max
+from text_generation import (StatefulGenerator, make_shakespeare_model,
+                             reference_extend_text)
+
+
+class CompiledGenerator:
+    def __init__(self, model, text_vec_layer, batch_size=32, max_chars=512):
+        self.generator = StatefulGenerator(model, text_vec_layer)
+        self.codec = self.generator.codec
+        self.batch_size = batch_size
+        self.max_chars = max_chars
+        embedding, gru, dense = model.layers
+        self.embeddings = embedding.embeddings
+        self.cell = gru.cell
+        self.dense_kernel, self.dense_bias = dense.kernel, dense.bias
+        self._generate = tf.function(self._generate, jit_compile=True)
+
+    def _generate(self, state, temperatures, n_chars, seed):
+        rows = tf.range(tf.shape(state)[0])
+
+        def body(i, state, output):
+            # the Dense layer's softmax is left out: sampling needs logits
+            logits = state @ self.dense_kernel + self.dense_bias
+            noise = tf.random.stateless_uniform(
+                tf.shape(logits), tf.stack([seed, tf.cast(i, tf.int64)]),
+                minval=1e-20)
+            char_ids = gumbel_max(logits / temperatures[:, tf.newaxis], noise)
+            # write column i only, so a step does not copy the whole buffer
+            output = tf.tensor_scatter_nd_update(
+                output, tf.stack([rows, tf.fill(tf.shape(rows), i)], axis=1),
+                char_ids)
+            inputs = tf.gather(self.embeddings, char_ids)
+            state, _ = self.cell(inputs, [state])
+            return i + 1, state, output
+
+        output = tf.zeros([tf.shape(state)[0], self.max_chars], tf.int32)
+        _, _, output = tf.while_loop(lambda i, *_: i < n_chars, body,
+                                     [tf.constant(0), state, output])
+        return output
+
+    def generate(self, prompts, n_chars=50, temperatures=1, seed=None):
+        """Extends every prompt by `n_chars` (at most `max_chars`) characters.
+
+        `temperatures` is a single number or one per prompt. The whole call is
+        reproducible for a given `seed`.
+        """
+        if n_chars > self.max_chars:
+            raise ValueError(f"n_chars must be at most {self.max_chars}")
+        prompts = list(prompts)
+        temperatures = tf.broadcast_to(
+            tf.constant(temperatures, tf.float32), [len(prompts)])
+        seed = (tf.random.uniform([], maxval=tf.int64.max, dtype=tf.int64)
+                if seed is None else tf.constant(seed, tf.int64))
+        texts = []
+        for start in range(0, len(prompts), self.batch_size):
+            batch = prompts[start:start + self.batch_size]
+            _, state = self.generator.feed_prompts(
+                *self.generator.encode_batch(batch))
+            n_padding = self.batch_size - len(batch)
+            state = tf.pad(state, [[0, n_padding], [0, 0]])
+            batch_temperatures = tf.pad(
+                temperatures[start:start + self.batch_size], [[0, n_padding]],
+                constant_values=1)
+            output = self._generate(state, batch_temperatures,
+                                    tf.constant(n_chars), seed + start)
+            generated = self.codec.decode_batch(
+                output[:len(batch), :n_chars].numpy())
+            texts.extend(prompt + text
+                         for prompt, text in zip(batch, generated))
+        return texts
+
+
+def benchmark(model, text_vec_layer, batch_sizes=(1, 32), n_chars=200,
+              n_reference_chars=20, text="To be, or not to be"):
+    """Returns milliseconds per generated character for each loop."""
+    results = {}
+    shakespeare_model = make_shakespeare_model(model, text_vec_layer)
+    start = time.perf_counter()
+    reference_extend_text(shakespeare_model, text_vec_layer, text,
+                          n_reference_chars)
+    results["notebook extend_text, batch 1"] = (
+        (time.perf_counter() - start) / n_reference_chars * 1e3)
+    stateful = StatefulGenerator(model, text_vec_layer)
+    for batch_size in batch_sizes:
+        compiled = CompiledGenerator(model, text_vec_layer, batch_size,
+                                     max_chars=n_chars)
+        prompts = [text] * batch_size
+        loops = {"StatefulGenerator.generate": stateful.generate,
+                 "CompiledGenerator.generate": compiled.generate}
+        for name, generate in loops.items():
+            generate(prompts, n_chars=n_chars)  # trace and compile
+            start = time.perf_counter()
+            generate(prompts, n_chars=n_chars)
+            results[f"{name}, batch {batch_size}"] = (
+                (time.perf_counter() - start) / n_chars * 1e3)
+    return results
+
+
+if __name__ == "__main__":
+    from text_datasets import load_shakespeare
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model-dir", default="my_shakespeare_model")
+    parser.add_argument("--n-chars", type=int, default=200)
+    args = parser.parse_args()
+    text_vec_layer, _ = load_shakespeare()
+    model = tf.keras.models.load_model(args.model_dir)
+    for name, millis in benchmark(model, text_vec_layer,
+                                  n_chars=args.n_chars).items():
+        print(f"{name:>40}: {millis:8.3f} ms/char")
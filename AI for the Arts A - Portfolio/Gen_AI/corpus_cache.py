@@ -0,0 +1,123 @@
+"""A persistent, memory-mapped cache of the encoded training corpus.
+
+Every run of the notebook reads shakespeare.txt, adapts `text_vec_layer` to
+it and encodes all 1.1M characters into an int64 tensor. With this cache the
+first run does exactly that (so the character IDs match the notebook and the
+saved model), then stores the vocabulary as JSON and the encoded text as a
+uint8 `.npy` file keyed on the SHA-256 of the source text. Later runs memory-map
+the `.npy` file, and the train, validation and test sets are slices of the
+memory map, so no copy of the corpus is made until a batch is actually read.
+
+    vocabulary, encoded = load_corpus(filepath)
+    train, valid, test = split_corpus(encoded)
+    text_vec_layer = make_text_vec_layer(vocabulary)
+
+To avoid re-hashing an unchanged file on every run, the content hash of each
+source file is remembered next to the cache together with its size and
+modification time.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+default_cache_dir = "corpus_cache"
+cache_format = "char-lower-v1"  # bump when the encoding changes
+
+
+def _atomic_write(path, write):
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def content_hash(filepath, cache_dir=default_cache_dir):
+    """Returns the SHA-256 of `filepath`, re-hashing only if it changed."""
+    stat = os.stat(filepath)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    stamps_path = os.path.join(cache_dir, "stamps.json")
+    try:
+        with open(stamps_path) as f:
+            stamps = json.load(f)
+    except FileNotFoundError:
+        stamps = {}
+    key = os.path.abspath(filepath)
+    if key in stamps and stamps[key]["stamp"] == stamp:
+        return stamps[key]["sha256"]
+    sha256 = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    stamps[key] = {"stamp": stamp, "sha256": sha256.hexdigest()}
+    _atomic_write(stamps_path, lambda f: f.write(json.dumps(stamps).encode()))
+    return sha256.hexdigest()
+
+
+def encode_text(text):
+    """Adapts a `TextVectorization` layer to `text` and encodes it.
+
+    Returns the vocabulary in model ID order (without the pad and unknown
+    tokens) and the encoded text as uint8, with 2 subtracted from every ID.
+    """
+    import tensorflow as tf
+
+    text_vec_layer = tf.keras.layers.TextVectorization(split="character",
+                                                       standardize="lower")
+    text_vec_layer.adapt([text])
+    vocabulary = text_vec_layer.get_vocabulary()[2:]
+    if len(vocabulary) > 256:
+        raise ValueError(f"{len(vocabulary)} distinct characters do not fit "
+                         "in uint8")
+    encoded = text_vec_layer([text])[0].numpy() - 2
+    return vocabulary, encoded.astype(np.uint8)
+
+
+def load_corpus(filepath, cache_dir=default_cache_dir):
+    """Returns `(vocabulary, encoded)` for the text file at `filepath`.
+
+    `encoded` is a read-only, memory-mapped uint8 array. It is built and
+    cached on the first call for a given file content.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    key = f"{cache_format}-{content_hash(filepath, cache_dir)}"
+    npy_path = os.path.join(cache_dir, f"{key}.npy")
+    vocab_path = os.path.join(cache_dir, f"{key}.vocab.json")
+    if not (os.path.exists(npy_path) and os.path.exists(vocab_path)):
+        with open(filepath) as f:
+            vocabulary, encoded = encode_text(f.read())
+        _atomic_write(npy_path, lambda f: np.save(f, encoded))
+        _atomic_write(vocab_path,
+                      lambda f: f.write(json.dumps(vocabulary).encode()))
+    with open(vocab_path) as f:
+        vocabulary = json.load(f)
+    return vocabulary, np.load(npy_path, mmap_mode="r")
+
+
+def split_corpus(encoded, n_train=1_000_000, n_valid=60_000):
+    """Splits `encoded` like the notebook does, as views without copying."""
+    return (encoded[:n_train], encoded[n_train:n_train + n_valid],
+            encoded[n_train + n_valid:])
+
+
+def make_text_vec_layer(vocabulary):
+    """Rebuilds the notebook's `text_vec_layer` without adapting it."""
+    import tensorflow as tf
+
+    return tf.keras.layers.TextVectorization(
+        split="character", standardize="lower", vocabulary=vocabulary)
+
+
+def load_shakespeare(cache_dir=default_cache_dir):
+    """Cached counterpart of `text_datasets.load_shakespeare`.
+
+    Returns the vocabulary and the memory-mapped encoded text.
+    """
+    import tensorflow as tf
+
+    from text_datasets import shakespeare_url
+
+    filepath = tf.keras.utils.get_file("shakespeare.txt", shakespeare_url)
+    return load_corpus(filepath, cache_dir)
@@ -0,0 +1,172 @@
+"""Knowledge distillation of the GRU(128) char-RNN into a smaller student.
+
+Generation cost is dominated by the GRU(128) layer. A student built by
+`char_rnn_model.build_model` with fewer GRU units (and optionally a narrower
+embedding) is trained on `train_set` to match the teacher's next-character
+distributions, softened by a `temperature`, as well as the true next
+characters:
+
+    loss = alpha * T² * KL(teacher_T || student_T)
+           + (1 - alpha) * crossentropy(Y, student)
+
+The soft targets carry what the teacher learned about which characters are
+plausible, so a small student gets closer to the teacher than the same model
+trained on the text alone. The student is a plain char-RNN, saved as a
+SavedModel that `StatefulGenerator` and the other serving code load like
+`my_shakespeare_model`.
+
+    python distillation.py --units 32 64 --epochs 3
+
+prints size, per-character generation latency and validation log-loss and
+accuracy for the teacher and every student.
+"""
+
+import argparse
+import os
+import time
+
+import tensorflow as tf
+
+from char_rnn_model import build_model, model_dims
+
+
+class Distiller(tf.keras.Model):
+    """Trains `student` on the soft outputs of a frozen `teacher`."""
+
+    def __init__(self, student, teacher, temperature=2.0, alpha=0.9):
+        super().__init__()
+        self.student = student
+        self.teacher = teacher
+        self.teacher.trainable = False
+        self.temperature = temperature
+        self.alpha = alpha
+        self.loss_tracker = tf.keras.metrics.Mean(name="loss")
+        self.accuracy = tf.keras.metrics.SparseCategoricalAccuracy(
+            name="accuracy")
+
+    @property
+    def metrics(self):
+        return [self.loss_tracker, self.accuracy]
+
+    def call(self, inputs, training=False):
+        return self.student(inputs, training=training)
+
+    def distillation_loss(self, Y, teacher_probas, student_probas):
+        T = self.temperature
+        soft_targets = tf.nn.softmax(tf.math.log(teacher_probas + 1e-12) / T)
+        student_log_probas = tf.nn.log_softmax(
+            tf.math.log(student_probas + 1e-12) / T)
+        kl = tf.reduce_sum(
+            soft_targets * (tf.math.log(soft_targets + 1e-12)
+                            - student_log_probas), axis=-1)
+        hard_loss = tf.keras.losses.sparse_categorical_crossentropy(
+            Y, student_probas)
+        return tf.reduce_mean(self.alpha * T ** 2 * kl
+                              + (1 - self.alpha) * hard_loss)
+
+    def train_step(self, data):
+        X, Y = data
+        teacher_probas = self.teacher(X, training=False)
+        with tf.GradientTape() as tape:
+            student_probas = self.student(X, training=True)
+            loss = self.distillation_loss(Y, teacher_probas, student_probas)
+        variables = self.student.trainable_variables
+        self.optimizer.apply_gradients(
+            zip(tape.gradient(loss, variables), variables))
+        self.loss_tracker.update_state(loss)
+        self.accuracy.update_state(Y, student_probas)
+        return {metric.name: metric.result() for metric in self.metrics}
+
+    def test_step(self, data):
+        X, Y = data
+        student_probas = self.student(X, training=False)
+        self.loss_tracker.update_state(tf.reduce_mean(
+            tf.keras.losses.sparse_categorical_crossentropy(
+                Y, student_probas)))
+        self.accuracy.update_state(Y, student_probas)
+        return {metric.name: metric.result() for metric in self.metrics}
+
+
+def distill(teacher, train_set, valid_set, units=64, embed_dim=None,
+            epochs=3, temperature=2.0, alpha=0.9):
+    """Returns a student with `units` GRU units, trained on `teacher`.
+
+    `embed_dim` defaults to the teacher's embedding size.
+    """
+    n_tokens, teacher_embed_dim, _ = model_dims(teacher)
+    student = build_model(n_tokens, embed_dim or teacher_embed_dim, units)
+    distiller = Distiller(student, teacher, temperature, alpha)
+    distiller.compile(optimizer="nadam")
+    distiller.fit(train_set, validation_data=valid_set, epochs=epochs)
+    return student
+
+
+def generation_latency_ms(model, text_vec_layer, n_chars=200):
+    from text_generation import StatefulGenerator
+
+    generator = StatefulGenerator(model, text_vec_layer)
+    generator.generate(["To be, or not to be"], n_chars=5)  # trace
+    start = time.perf_counter()
+    generator.generate(["To be, or not to be"], n_chars=n_chars)
+    return (time.perf_counter() - start) / n_chars * 1e3
+
+
+def compare(models, text_vec_layer, valid_ids):
+    """Size, batch-1 latency and validation scores of each model.
+
+    `models` maps SavedModel directories to the loaded models.
+    """
+    from evaluation import StatefulEvaluator
+    from quantization import directory_size
+
+    rows = []
+    for model_dir, model in models.items():
+        scores = StatefulEvaluator(model).evaluate(valid_ids)
+        rows.append({"model": model_dir, "units": model_dims(model)[2],
+                     "parameters": model.count_params(),
+                     "saved_mb": (directory_size(model_dir) / 2**20
+                                  if os.path.isdir(model_dir) else None),
+                     "ms_per_char": generation_latency_ms(model,
+                                                          text_vec_layer),
+                     "val_log_loss": scores["log_loss"],
+                     "val_accuracy": scores["accuracy"]})
+    return rows
+
+
+def main(argv=None):
+    from text_datasets import load_shakespeare, to_dataset_fast
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model-dir", default="my_shakespeare_model")
+    parser.add_argument("--units", type=int, nargs="+", default=[32, 64])
+    parser.add_argument("--embed-dim", type=int)
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--temperature", type=float, default=2.0)
+    parser.add_argument("--alpha", type=float, default=0.9)
+    args = parser.parse_args(argv)
+
+    text_vec_layer, encoded = load_shakespeare()
+    teacher = tf.keras.models.load_model(args.model_dir)
+    train_set = to_dataset_fast(encoded[:1_000_000], length=100, shuffle=True,
+                                seed=42)
+    valid_set = to_dataset_fast(encoded[1_000_000:1_060_000], length=100)
+    models = {args.model_dir: teacher}
+    for units in args.units:
+        tf.random.set_seed(42)
+        student = distill(teacher, train_set, valid_set, units,
+                          args.embed_dim, args.epochs, args.temperature,
+                          args.alpha)
+        export_dir = f"{args.model_dir}_student_{units}"
+        student.save(export_dir)
+        models[export_dir] = student
+    print(f"{'model':>36} {'units':>5} {'params':>8} {'MB':>6} "
+          f"{'ms/char':>8} {'val loss':>8} {'val acc':>8}")
+    for row in compare(models, text_vec_layer,
+                       encoded[1_000_000:1_060_000].numpy()):
+        print(f"{row['model']:>36} {row['units']:>5} {row['parameters']:>8,} "
+              f"{row['saved_mb']:>6.2f} {row['ms_per_char']:>8.3f} "
+              f"{row['val_log_loss']:>8.4f} {row['val_accuracy']:>8.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""Multi-process, data-parallel CPU training for the Shakespeare char-RNN.
+
+A single `model.fit` process leaves most cores of a many-core box idle. This
+script starts `--workers` local processes that train the notebook's model
+(`char_rnn_model.build_model`) under `tf.distribute.MultiWorkerMirroredStrategy`:
+every worker holds a replica of the model, reads its own shard of the
+training windows (`to_dataset_fast(..., num_shards, shard_index)`), and the
+gradients are averaged with a synchronous all-reduce before every update.
+Each worker gets an equal share of the CPU threads.
+
+    python distributed_training.py --workers 4 --epochs 10
+    python distributed_training.py --benchmark 1 2 4 8
+
+`--benchmark` trains one epoch for each worker count and prints the epoch
+times. The per-worker batch size stays at `--batch-size`, so the global batch
+grows with the number of workers, and an epoch covers every training window
+whatever the number of workers.
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def _free_ports(n):
+    sockets = [socket.socket() for _ in range(n)]
+    for s in sockets:
+        s.bind(("localhost", 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def launch(n_workers, epochs=10, length=100, batch_size=32,
+           steps_per_epoch=None, save_path=None):
+    """Runs `n_workers` local worker processes; returns the chief's report."""
+    ports = _free_ports(n_workers)
+    cluster = {"worker": [f"localhost:{port}" for port in ports]}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        report_path = os.path.join(tmp_dir, "report.json")
+        workers = []
+        for index in range(n_workers):
+            env = dict(os.environ, TF_CONFIG=json.dumps(
+                {"cluster": cluster, "task": {"type": "worker",
+                                              "index": index}}))
+            command = [sys.executable, __file__, "--worker",
+                       "--workers", str(n_workers), "--epochs", str(epochs),
+                       "--length", str(length), "--batch-size",
+                       str(batch_size), "--report", report_path]
+            if steps_per_epoch:
+                command += ["--steps-per-epoch", str(steps_per_epoch)]
+            if save_path:
+                command += ["--save", save_path]
+            workers.append(subprocess.Popen(command, env=env))
+        codes = [worker.wait() for worker in workers]
+        if any(codes):
+            raise RuntimeError(f"worker exit codes: {codes}")
+        with open(report_path) as f:
+            return json.load(f)
+
+
+def run_worker(n_workers, epochs, length, batch_size, report_path,
+               steps_per_epoch=None, save_path=None):
+    import tensorflow as tf
+
+    threads = max(1, (os.cpu_count() or 1) // n_workers)
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    task = json.loads(os.environ["TF_CONFIG"])["task"]
+    is_chief = task["index"] == 0
+
+    from char_rnn_model import build_model
+    from text_datasets import load_shakespeare, to_dataset_fast
+
+    text_vec_layer, encoded = load_shakespeare()
+    n_tokens = text_vec_layer.vocabulary_size() - 2
+    train_text = encoded[:1_000_000]
+    if steps_per_epoch is None:
+        # every worker must run the same number of steps, or the all-reduce
+        # waits forever for the worker that ran out of data
+        n_windows = (len(train_text) - length) // n_workers
+        steps_per_epoch = n_windows // batch_size
+    # `fit` treats each worker's batches as global batches and splits them
+    # across all the replicas, so batch the global batch to get `batch_size`
+    # windows per worker and per step
+    global_batch_size = batch_size * n_workers
+    tf.random.set_seed(42)
+    train_set = to_dataset_fast(
+        train_text, length=length, shuffle=True, seed=42,
+        batch_size=global_batch_size, num_shards=n_workers,
+        shard_index=task["index"]).repeat()
+    valid_set = to_dataset_fast(encoded[1_000_000:1_060_000], length=length,
+                                batch_size=global_batch_size,
+                                num_shards=n_workers,
+                                shard_index=task["index"]).repeat()
+    validation_steps = (60_000 - length) // n_workers // batch_size
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = (
+        tf.data.experimental.AutoShardPolicy.OFF)  # already sharded above
+    train_set = train_set.with_options(options)
+    valid_set = valid_set.with_options(options)
+
+    with strategy.scope():
+        model = build_model(n_tokens)
+    epoch_times = []
+
+    class EpochTimer(tf.keras.callbacks.Callback):
+        def on_epoch_begin(self, epoch, logs=None):
+            self.start = time.perf_counter()
+
+        def on_epoch_end(self, epoch, logs=None):
+            epoch_times.append(time.perf_counter() - self.start)
+
+    history = model.fit(train_set, epochs=epochs,
+                        steps_per_epoch=steps_per_epoch,
+                        validation_data=valid_set,
+                        validation_steps=validation_steps,
+                        callbacks=[EpochTimer()],
+                        verbose=2 if is_chief else 0)
+    if save_path:
+        # all workers take part in saving; only the chief's copy is kept
+        model.save_weights(save_path if is_chief else os.path.join(
+            tempfile.mkdtemp(), "weights"))
+    if is_chief:
+        with open(report_path, "w") as f:
+            json.dump({"workers": n_workers, "epoch_times": epoch_times,
+                       "steps_per_epoch": steps_per_epoch,
+                       "windows_per_epoch": (steps_per_epoch
+                                             * global_batch_size),
+                       "history": history.history}, f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--length", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=32,
+                        help="per-worker batch size")
+    parser.add_argument("--steps-per-epoch", type=int)
+    parser.add_argument("--save", help="save the trained weights here")
+    parser.add_argument("--benchmark", type=int, nargs="+", metavar="N",
+                        help="time one epoch with N workers, for each N")
+    parser.add_argument("--worker", action="store_true",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--report", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        run_worker(args.workers, args.epochs, args.length, args.batch_size,
+                   args.report, args.steps_per_epoch, args.save)
+    elif args.benchmark:
+        for n_workers in args.benchmark:
+            report = launch(n_workers, epochs=1, length=args.length,
+                            batch_size=args.batch_size,
+                            steps_per_epoch=args.steps_per_epoch)
+            print(f"{n_workers} worker(s): epoch time "
+                  f"{report['epoch_times'][0]:8.1f}s "
+                  f"({report['steps_per_epoch']} steps, "
+                  f"{report['windows_per_epoch']:,} windows)")
+    else:
+        report = launch(args.workers, args.epochs, args.length,
+                        args.batch_size, args.steps_per_epoch, args.save)
+        print(json.dumps(report["history"], indent=2))
+
+
+if __name__ == "__main__":
+    main()
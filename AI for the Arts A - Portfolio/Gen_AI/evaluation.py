@@ -0,0 +1,201 @@
+"""Stateful, single-pass evaluation of the char-RNN on long held-out text.
+
+`model.evaluate(test_set)` (and `validation_data=valid_set` in `fit`) scores
+about 60,000 overlapping 100-character windows, so every character goes
+through the GRU about 100 times, and each prediction only sees the up to 99
+characters before it in its window. `StatefulEvaluator` instead cuts the text
+into `batch_size` contiguous streams and runs them left to right in chunks of
+`chunk_length` steps, carrying the GRU state from one chunk to the next: one
+GRU step per character, and every prediction sees the whole stream before it.
+
+    evaluator = StatefulEvaluator(model)
+    evaluator.evaluate(encoded[1_060_000:], breakdown=True)
+
+returns the mean log-loss per character (in nats), bits per character,
+perplexity and next-character accuracy; `breakdown=True` adds the log-loss
+by position in the stream and by target character. `StatefulValidation` runs
+the same evaluation, on an evenly spaced sample of `max_chars` characters,
+at the end of every epoch of `fit`, and adds the scores to the epoch logs:
+
+    model.fit(train_set, epochs=10, callbacks=[
+        StatefulValidation(encoded[1_000_000:1_060_000], max_chars=20_000)])
+
+    python evaluation.py --split test --breakdown
+"""
+
+import argparse
+import math
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from text_generation import make_step_model
+
+position_buckets = [0, 10, 100, 1000, 10_000]  # bucket start positions
+
+
+class StatefulEvaluator:
+    """Scores encoded text with one GRU step per character."""
+
+    def __init__(self, model, batch_size=32, chunk_length=1000,
+                 vocabulary=None):
+        self.step_model = make_step_model(model)
+        self.batch_size = batch_size
+        self.chunk_length = chunk_length
+        self.vocabulary = vocabulary
+        self.units = self.step_model.inputs[1].shape[-1]
+        self._score = tf.function(self._score, input_signature=[
+            tf.TensorSpec([batch_size, None], tf.int32),
+            tf.TensorSpec([batch_size, None], tf.int32),
+            tf.TensorSpec([batch_size, self.units], tf.float32)])
+
+    def sync(self, model):
+        """Copies the current weights of `model`, e.g. during training."""
+        self.step_model.set_weights(model.get_weights())
+
+    def _score(self, inputs, targets, state):
+        probas, state = self.step_model([inputs, state])
+        target_probas = tf.gather(probas, targets, batch_dims=2)
+        log_losses = -tf.math.log(tf.maximum(target_probas, 1e-12))
+        correct = tf.argmax(probas, axis=-1, output_type=tf.int32) == targets
+        return log_losses, correct, state
+
+    def streams(self, char_ids, max_chars=None):
+        """Cuts `char_ids` into `batch_size` rows of contiguous text.
+
+        With `max_chars`, the rows are evenly spaced segments of
+        `max_chars // batch_size` characters instead of the whole text.
+        """
+        char_ids = np.asarray(char_ids, np.int32)
+        n_steps = len(char_ids) // self.batch_size
+        streams = char_ids[:n_steps * self.batch_size].reshape(
+            self.batch_size, n_steps)
+        if max_chars is not None:
+            streams = streams[:, :max(2, max_chars // self.batch_size)]
+        return streams
+
+    def evaluate(self, char_ids, max_chars=None, breakdown=False):
+        """Returns the scores of the model on `char_ids` (see module doc)."""
+        streams = self.streams(char_ids, max_chars)
+        if streams.shape[1] < 2:
+            raise ValueError("text too short for this batch size")
+        state = tf.zeros([self.batch_size, self.units])
+        log_losses, correct = [], []
+        for start in range(0, streams.shape[1] - 1, self.chunk_length):
+            chunk = streams[:, start:start + self.chunk_length + 1]
+            chunk_losses, chunk_correct, state = self._score(
+                chunk[:, :-1], chunk[:, 1:], state)
+            log_losses.append(chunk_losses.numpy())
+            correct.append(chunk_correct.numpy())
+        log_losses = np.concatenate(log_losses, axis=1)
+        correct = np.concatenate(correct, axis=1)
+        log_loss = float(log_losses.mean())
+        scores = {"log_loss": log_loss,
+                  "bits_per_char": log_loss / math.log(2),
+                  "perplexity": math.exp(log_loss),
+                  "accuracy": float(correct.mean()),
+                  "chars": int(log_losses.size)}
+        if breakdown:
+            scores["by_position"] = self._by_position(log_losses)
+            scores["by_target"] = self._by_target(log_losses, streams[:, 1:])
+        return scores
+
+    def _by_position(self, log_losses):
+        """Mean log-loss by position in the stream (context length)."""
+        by_position = {}
+        bounds = position_buckets + [log_losses.shape[1]]
+        for low, high in zip(bounds, bounds[1:]):
+            if low < high:
+                by_position[f"{low}-{high - 1}"] = float(
+                    log_losses[:, low:high].mean())
+        return by_position
+
+    def _by_target(self, log_losses, targets):
+        """Mean log-loss and count for each target character."""
+        totals = np.bincount(targets.ravel(), weights=log_losses.ravel())
+        counts = np.bincount(targets.ravel())
+        by_target = {}
+        for char_id in np.flatnonzero(counts):
+            name = (self.vocabulary[char_id] if self.vocabulary
+                    else int(char_id))
+            by_target[name] = {"log_loss": totals[char_id] / counts[char_id],
+                               "count": int(counts[char_id])}
+        return by_target
+
+
+class StatefulValidation(tf.keras.callbacks.Callback):
+    """Adds `val_log_loss`, `val_perplexity` and `val_accuracy` to the logs.
+
+    The scores come from a `StatefulEvaluator` run on `char_ids` (sampled
+    down to `max_chars` characters, if given) at the end of every epoch, so
+    `fit` does not need `validation_data`.
+    """
+
+    def __init__(self, char_ids, max_chars=20_000, batch_size=32,
+                 chunk_length=1000, prefix="val_"):
+        super().__init__()
+        self.char_ids = np.asarray(char_ids)
+        self.max_chars = max_chars
+        self.batch_size = batch_size
+        self.chunk_length = chunk_length
+        self.prefix = prefix
+        self.evaluator = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.evaluator is None:
+            self.evaluator = StatefulEvaluator(self.model, self.batch_size,
+                                               self.chunk_length)
+        else:
+            self.evaluator.sync(self.model)
+        scores = self.evaluator.evaluate(self.char_ids, self.max_chars)
+        if logs is not None:
+            for name in ["log_loss", "perplexity", "accuracy"]:
+                logs[self.prefix + name] = scores[name]
+
+
+def main(argv=None):
+    from text_datasets import load_shakespeare, to_dataset_fast
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model-dir", default="my_shakespeare_model")
+    parser.add_argument("--split", choices=["valid", "test"], default="test")
+    parser.add_argument("--max-chars", type=int)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--chunk-length", type=int, default=1000)
+    parser.add_argument("--breakdown", action="store_true")
+    parser.add_argument("--compare", action="store_true",
+                        help="also time model.evaluate on 100-char windows")
+    args = parser.parse_args(argv)
+
+    text_vec_layer, encoded = load_shakespeare()
+    encoded = encoded.numpy()
+    char_ids = (encoded[1_000_000:1_060_000] if args.split == "valid"
+                else encoded[1_060_000:])
+    model = tf.keras.models.load_model(args.model_dir)
+    evaluator = StatefulEvaluator(model, args.batch_size, args.chunk_length,
+                                  text_vec_layer.get_vocabulary()[2:])
+    evaluator.evaluate(char_ids[:evaluator.batch_size * 2])  # trace
+    start = time.perf_counter()
+    scores = evaluator.evaluate(char_ids, args.max_chars, args.breakdown)
+    elapsed = time.perf_counter() - start
+    print(f"stateful: log-loss {scores['log_loss']:.4f}, perplexity "
+          f"{scores['perplexity']:.3f}, accuracy {scores['accuracy']:.4f} "
+          f"over {scores['chars']:,} chars in {elapsed:.2f}s")
+    if args.breakdown:
+        for bucket, log_loss in scores["by_position"].items():
+            print(f"  positions {bucket:>14}: log-loss {log_loss:.4f}")
+        for char, score in sorted(scores["by_target"].items(),
+                                  key=lambda item: -item[1]["count"]):
+            print(f"  target {char!r:>6}: log-loss {score['log_loss']:.4f} "
+                  f"({score['count']:,} chars)")
+    if args.compare:
+        windows = to_dataset_fast(char_ids, length=100)
+        start = time.perf_counter()
+        loss, accuracy = model.evaluate(windows, verbose=0)
+        print(f"model.evaluate on windows: log-loss {loss:.4f}, accuracy "
+              f"{accuracy:.4f} in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
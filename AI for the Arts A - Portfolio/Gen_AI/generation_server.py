@@ -0,0 +1,350 @@
+"""A local HTTP text-generation service with dynamic micro-batching.
+
+Calling `extend_text` once per HTTP request would run one batch-of-one GRU
+step per character per request. Here a `DynamicBatcher` owns the GRU states of
+all in-flight requests and advances them together, one batched step (and one
+batched sample) per character. When idle, it waits `max_wait_ms` for more
+requests to arrive before starting; while busy, new requests join the batch
+before the next step, and finished ones leave it right away, so a short
+request never waits for a long one.
+
+    python generation_server.py serve --port 8000
+    curl -d '{"prompt": "To be, or not to be", "n_chars": 100}' \\
+        localhost:8000/generate
+
+`POST /generate` takes a JSON object with `prompt` and optionally `n_chars`,
+`temperature`, `top_k`, `top_p` and `repetition_penalty`, and returns
+`{"text": ...}`. Options are checked before a request joins a batch, so a
+bad request gets a 400 without failing the others. `GET /stats` returns
+batching statistics.
+
+The load-test mode reports p50/p99 latency and characters per second at
+several concurrency levels against a running server:
+
+    python generation_server.py load-test --concurrency 1 8 32 128
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import tensorflow as tf
+
+from text_generation import StatefulGenerator
+
+
+@dataclass(eq=False)
+class _Request:
+    prompt: str
+    n_chars: int
+    options: dict
+    future: asyncio.Future
+    generated: list = field(default_factory=list)
+
+
+class DynamicBatcher:
+    option_dtypes = {"temperature": tf.float32, "top_k": tf.int32,
+                     "top_p": tf.float32, "repetition_penalty": tf.float32}
+    default_options = {"temperature": 1.0, "top_k": 0, "top_p": 1.0,
+                       "repetition_penalty": 1.0}
+
+    def __init__(self, generator, max_batch_size=256, max_wait_ms=5.0,
+                 max_chars=10_000):
+        self.generator = generator
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_chars = max_chars
+        self.queue = asyncio.Queue()
+        # TensorFlow calls block, so they run off the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.stats = {"requests": 0, "steps": 0, "chars": 0}
+
+    def check_options(self, n_chars, options):
+        """Returns `n_chars` and the full options, converted and checked.
+
+        Raises a ValueError or TypeError for anything the batched step could
+        not use, before the request can fail a whole batch.
+        """
+        unknown = set(options) - set(self.default_options)
+        if unknown:
+            raise ValueError(f"unknown options: {sorted(unknown)}")
+        options = {**self.default_options, **options}
+        for name in ("temperature", "top_p", "repetition_penalty"):
+            options[name] = float(options[name])
+            if not math.isfinite(options[name]):
+                raise ValueError(f"{name} must be finite")
+        n_chars = _to_int("n_chars", n_chars)
+        options["top_k"] = _to_int("top_k", options["top_k"])
+        if options["temperature"] <= 0:
+            raise ValueError("temperature must be positive")
+        if not 0 < options["top_p"] <= 1:
+            raise ValueError("top_p must be in (0, 1]")
+        if options["repetition_penalty"] <= 0:
+            raise ValueError("repetition_penalty must be positive")
+        if options["top_k"] < 0:
+            raise ValueError("top_k must not be negative")
+        if not 0 <= n_chars <= self.max_chars:
+            raise ValueError(f"n_chars must be in [0, {self.max_chars}]")
+        return n_chars, options
+
+    async def submit(self, prompt, n_chars=50, **options):
+        """Queues a request and returns the extended prompt when done.
+
+        Cancelling the caller (e.g. when the client goes away) cancels the
+        request, which then leaves the batch before the next step.
+        """
+        if not isinstance(prompt, str):
+            raise TypeError("prompt must be a string")
+        n_chars, options = self.check_options(n_chars, options)
+        self.generator.encode(prompt)  # fail fast on unusable prompts
+        if n_chars == 0:
+            return prompt
+        request = _Request(prompt, n_chars, options,
+                           asyncio.get_running_loop().create_future())
+        await self.queue.put(request)
+        return await request.future
+
+    def _drain(self, limit):
+        requests = []
+        while len(requests) < limit and not self.queue.empty():
+            request = self.queue.get_nowait()
+            if not request.future.done():  # cancelled while queued
+                requests.append(request)
+        return requests
+
+    def _admit(self, requests, probas, state, counts):
+        """Runs the new prompts through the GRU and appends their rows."""
+        new_probas, new_state = self.generator.feed_prompts(
+            *self.generator.encode_batch([r.prompt for r in requests]))
+        new_counts = tf.zeros([len(requests), len(self.generator.codec)],
+                              tf.int32)
+        if probas is None:
+            return new_probas, new_state, new_counts
+        return (tf.concat([probas, new_probas], axis=0),
+                tf.concat([state, new_state], axis=0),
+                tf.concat([counts, new_counts], axis=0))
+
+    def _step(self, active, probas, state, counts):
+        options = {name: tf.constant([r.options[name] for r in active], dtype)
+                   for name, dtype in self.option_dtypes.items()}
+        char_ids, probas, state, counts = self.generator.sample_and_step(
+            probas, state, counts, options)
+        return char_ids.numpy(), probas, state, counts
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        active, probas, state, counts = [], None, None, None
+        while True:
+            if not active:
+                first = await self.queue.get()
+                await asyncio.sleep(self.max_wait_ms / 1000)
+                new = [first] + self._drain(self.max_batch_size - 1)
+                new = [request for request in new if not request.future.done()]
+                if not new:
+                    continue
+            else:
+                new = self._drain(self.max_batch_size - len(active))
+            try:
+                if new:
+                    probas, state, counts = await loop.run_in_executor(
+                        self.executor, self._admit, new, probas, state, counts)
+                    active += new
+                    self.stats["requests"] += len(new)
+                char_ids, probas, state, counts = await loop.run_in_executor(
+                    self.executor, self._step, active, probas, state, counts)
+            except Exception as error:  # fail this batch, keep serving
+                for request in set(active) | set(new):
+                    if not request.future.done():
+                        request.future.set_exception(error)
+                active, probas, state, counts = [], None, None, None
+                continue
+            self.stats["steps"] += 1
+            self.stats["chars"] += len(active)
+            keep = []
+            for row, (request, char_id) in enumerate(zip(active, char_ids)):
+                request.generated.append(char_id)
+                if request.future.done():  # cancelled: the client went away
+                    continue
+                if len(request.generated) < request.n_chars:
+                    keep.append(row)
+                else:
+                    request.future.set_result(
+                        request.prompt
+                        + self.generator.codec.decode(request.generated))
+            if len(keep) < len(active):
+                active = [active[row] for row in keep]
+                if active:
+                    probas, state, counts = (tf.gather(tensor, keep) for tensor
+                                             in (probas, state, counts))
+                else:
+                    probas = state = counts = None
+
+
+def _to_int(name, value):
+    if isinstance(value, bool) or not float(value).is_integer():
+        raise ValueError(f"{name} must be an integer")
+    return int(float(value))
+
+
+async def _read_request(reader):
+    method, path, _ = (await reader.readline()).decode().split(" ", 2)
+    headers = {}
+    while (line := (await reader.readline()).decode().strip()):
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, path, body
+
+
+def _write_response(writer, status, payload):
+    body = json.dumps(payload).encode()
+    writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+                 .encode() + body)
+
+
+async def _until_closed(reader):
+    """Returns when the client closes the connection."""
+    while await reader.read(4096):
+        pass
+
+
+async def _generate(batcher, reader, payload):
+    """Runs `batcher.submit`, cancelling it if the client goes away.
+
+    Returns the text, or None if the client went away first.
+    """
+    if not isinstance(payload, dict):
+        raise TypeError("the request body must be a JSON object")
+    if "prompt" not in payload:
+        raise KeyError("prompt")
+    generation = asyncio.ensure_future(batcher.submit(**payload))
+    closed = asyncio.ensure_future(_until_closed(reader))
+    await asyncio.wait([generation, closed],
+                       return_when=asyncio.FIRST_COMPLETED)
+    if not generation.done():
+        generation.cancel()  # also cancels the request's future
+        return None
+    closed.cancel()
+    return generation.result()
+
+
+def make_handler(batcher):
+    async def handle(reader, writer):
+        try:
+            method, path, body = await _read_request(reader)
+            if method == "POST" and path == "/generate":
+                text = await _generate(batcher, reader, json.loads(body))
+                if text is None:
+                    return
+                _write_response(writer, "200 OK", {"text": text})
+            elif method == "GET" and path == "/stats":
+                stats = dict(batcher.stats)
+                stats["mean_batch_size"] = (stats["chars"]
+                                            / max(stats["steps"], 1))
+                _write_response(writer, "200 OK", stats)
+            else:
+                _write_response(writer, "404 Not Found", {"error": path})
+        except (ValueError, KeyError, TypeError) as error:
+            _write_response(writer, "400 Bad Request", {"error": str(error)})
+        except Exception as error:  # answer, rather than drop the connection
+            _write_response(writer, "500 Internal Server Error",
+                            {"error": repr(error)})
+        finally:
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass  # the client went away
+            writer.close()
+
+    return handle
+
+
+async def serve(model, text_vec_layer, host="127.0.0.1", port=8000,
+                max_batch_size=256, max_wait_ms=5.0):
+    batcher = DynamicBatcher(StatefulGenerator(model, text_vec_layer),
+                             max_batch_size, max_wait_ms)
+    server = await asyncio.start_server(make_handler(batcher), host, port)
+    print(f"serving on http://{host}:{port}")
+    async with server:
+        await asyncio.gather(server.serve_forever(), batcher.run())
+
+
+async def _post(host, port, payload):
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(payload).encode()
+    writer.write(f"POST /generate HTTP/1.1\r\nHost: {host}\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    if not response.startswith(b"HTTP/1.1 200"):
+        raise RuntimeError(response.decode(errors="replace"))
+
+
+async def load_test(host, port, concurrency, n_requests, n_chars=100,
+                    prompt="To be, or not to be"):
+    """Sends `n_requests` requests, `concurrency` at a time.
+
+    Returns the p50 and p99 latencies in milliseconds and the number of
+    generated characters per second.
+    """
+    latencies = []
+    pending = iter(range(n_requests))
+
+    async def worker():
+        for _ in pending:
+            start = time.perf_counter()
+            await _post(host, port, {"prompt": prompt, "n_chars": n_chars})
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    percentiles = statistics.quantiles(latencies, n=100)
+    return {"concurrency": concurrency, "p50_ms": percentiles[49] * 1e3,
+            "p99_ms": percentiles[98] * 1e3,
+            "chars_per_s": n_requests * n_chars / elapsed}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve")
+    serve_parser.add_argument("--model-dir", default="my_shakespeare_model")
+    serve_parser.add_argument("--max-batch-size", type=int, default=256)
+    serve_parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    test_parser = subparsers.add_parser("load-test")
+    test_parser.add_argument("--concurrency", type=int, nargs="+",
+                             default=[1, 8, 32, 128])
+    test_parser.add_argument("--requests-per-worker", type=int, default=8)
+    test_parser.add_argument("--n-chars", type=int, default=100)
+    for subparser in (serve_parser, test_parser):
+        subparser.add_argument("--host", default="127.0.0.1")
+        subparser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        from text_datasets import load_shakespeare
+
+        text_vec_layer, _ = load_shakespeare()
+        model = tf.keras.models.load_model(args.model_dir)
+        asyncio.run(serve(model, text_vec_layer, args.host, args.port,
+                          args.max_batch_size, args.max_wait_ms))
+    else:
+        for concurrency in args.concurrency:
+            result = asyncio.run(load_test(
+                args.host, args.port, concurrency,
+                concurrency * args.requests_per_worker, args.n_chars))
+            print("concurrency {concurrency:>4}: p50 {p50_ms:8.1f} ms, "
+                  "p99 {p99_ms:8.1f} ms, {chars_per_s:10.0f} chars/s"
+                  .format(**result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""Parallel hyperparameter sweep for the char-RNN, with successive halving.
+
+Tuning `length`, the GRU width, the embedding size and the batch size used to
+mean editing the notebook and re-running `model.fit` by hand. `sweep` samples
+`n_configs` configurations from `search_space` and trains them on a local
+process pool, one TensorFlow process per worker with an equal share of the
+CPU threads. The encoded corpus is the `corpus_cache` `.npy` file, which
+every worker memory-maps read-only, so the operating system keeps a single
+copy of it in the page cache whatever the number of workers; training batches
+are gathered straight from the memory map.
+
+Trials are cut by successive halving: every configuration is trained for
+`min_steps` steps and scored on the validation text (a stateful pass over an
+evenly spaced sample, see `evaluation.StatefulEvaluator`), then the best
+`1 / eta` of them are trained further, up to `eta` times as many steps in
+total, and so on for `n_rungs` rungs. Survivors resume from their saved
+weights and optimizer state. Every evaluation is a row of the results table
+(CSV), with the validation log-loss and the trial's cumulative training time:
+
+    python hyperparameter_sweep.py --workers 4 --n-configs 27 --eta 3 \\
+        --min-steps 200 --output sweep.csv
+"""
+
+import argparse
+import concurrent.futures
+import csv
+import multiprocessing
+import os
+import random
+import time
+
+import numpy as np
+
+search_space = {
+    "length": [50, 100, 200],
+    "units": [64, 128, 256],
+    "embed_dim": [8, 16, 32],
+    "batch_size": [32, 64, 128],
+}
+
+_corpus = None  # the memory-mapped corpus, in each worker
+
+
+def sample_configs(n_configs, space=search_space, seed=42):
+    """Returns `n_configs` distinct configurations, or the whole grid."""
+    grid = [{}]
+    for name, values in space.items():
+        grid = [{**config, name: value} for config in grid for value in values]
+    return random.Random(seed).sample(grid, min(n_configs, len(grid)))
+
+
+def _init_worker(npy_path, n_threads):
+    global _corpus
+
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(n_threads)
+    _corpus = np.load(npy_path, mmap_mode="r")
+
+
+def _batches(train_text, length, batch_size, seed):
+    rng = np.random.default_rng(seed)
+    offsets = np.arange(length + 1)
+    while True:
+        starts = rng.integers(len(train_text) - length, size=batch_size)
+        windows = train_text[starts[:, np.newaxis] + offsets].astype(np.int32)
+        yield windows[:, :-1], windows[:, 1:]
+
+
+def run_trial(trial_id, config, steps, steps_done, work_dir, n_tokens,
+              n_train, n_valid, max_valid_chars):
+    """Trains a trial for `steps` more steps; returns its validation scores.
+
+    Runs in a pool worker. The weights and optimizer state are saved under
+    `work_dir` so that the next rung picks up where this one stopped.
+    """
+    import tensorflow as tf
+
+    from char_rnn_model import build_model
+    from evaluation import StatefulEvaluator
+
+    train_text = _corpus[:n_train]
+    valid_text = _corpus[n_train:n_train + n_valid]
+    tf.random.set_seed(trial_id)
+    model = build_model(n_tokens, config["embed_dim"], config["units"])
+    checkpoint_path = os.path.join(work_dir, f"trial-{trial_id}", "weights")
+    if steps_done:
+        model.load_weights(checkpoint_path)
+    start = time.perf_counter()
+    model.fit(_batches(train_text, config["length"], config["batch_size"],
+                       seed=(trial_id, steps_done)),
+              steps_per_epoch=steps, epochs=1, verbose=0)
+    train_seconds = time.perf_counter() - start
+    model.save_weights(checkpoint_path)
+    scores = StatefulEvaluator(model).evaluate(valid_text, max_valid_chars)
+    return {"trial": trial_id, **config, "steps": steps_done + steps,
+            "train_seconds": train_seconds,
+            "val_log_loss": scores["log_loss"],
+            "val_accuracy": scores["accuracy"]}
+
+
+def sweep(npy_path, n_tokens, configs, work_dir, n_workers=2, min_steps=200,
+          eta=3, n_rungs=3, n_train=1_000_000, n_valid=60_000,
+          max_valid_chars=20_000):
+    """Runs successive halving over `configs`; returns the results table.
+
+    `npy_path` is the encoded corpus (see `corpus_cache.load_corpus`) and
+    `n_tokens` the size of its vocabulary.
+
+    Each row is one evaluation of one trial; `wall_seconds` is the trial's
+    cumulative training time and `elapsed_seconds` the sweep's wall time.
+    """
+    n_threads = max(1, (os.cpu_count() or 1) // n_workers)
+    trials = dict(enumerate(configs))
+    steps_done = dict.fromkeys(trials, 0)
+    wall_seconds = dict.fromkeys(trials, 0.0)
+    rows = []
+    sweep_start = time.perf_counter()
+    context = multiprocessing.get_context("spawn")  # no forking TensorFlow
+    with concurrent.futures.ProcessPoolExecutor(
+            n_workers, mp_context=context, initializer=_init_worker,
+            initargs=(npy_path, n_threads)) as pool:
+        for rung in range(n_rungs):
+            budget = min_steps * eta ** rung
+            futures = [pool.submit(run_trial, trial_id, config,
+                                   budget - steps_done[trial_id],
+                                   steps_done[trial_id], work_dir, n_tokens,
+                                   n_train, n_valid, max_valid_chars)
+                       for trial_id, config in trials.items()]
+            results = []
+            for future in concurrent.futures.as_completed(futures):
+                row = future.result()
+                steps_done[row["trial"]] = row["steps"]
+                wall_seconds[row["trial"]] += row.pop("train_seconds")
+                row.update(rung=rung, wall_seconds=wall_seconds[row["trial"]],
+                           elapsed_seconds=time.perf_counter() - sweep_start)
+                results.append(row)
+                print(f"rung {rung} trial {row['trial']:>3}: "
+                      f"val_log_loss {row['val_log_loss']:.4f} after "
+                      f"{row['steps']} steps, {row['wall_seconds']:.0f}s")
+            rows.extend(results)
+            results.sort(key=lambda row: row["val_log_loss"])
+            survivors = results[:max(1, len(results) // eta)]
+            trials = {row["trial"]: trials[row["trial"]] for row in survivors}
+    return rows
+
+
+def write_table(rows, path):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main(argv=None):
+    from corpus_cache import load_shakespeare
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--n-configs", type=int, default=27)
+    parser.add_argument("--min-steps", type=int, default=200)
+    parser.add_argument("--eta", type=int, default=3)
+    parser.add_argument("--rungs", type=int, default=3)
+    parser.add_argument("--work-dir", default="sweep")
+    parser.add_argument("--output", default="sweep.csv")
+    args = parser.parse_args(argv)
+
+    vocabulary, encoded = load_shakespeare()  # builds the cache if needed
+    rows = sweep(encoded.filename, len(vocabulary),
+                 sample_configs(args.n_configs), args.work_dir, args.workers,
+                 args.min_steps, args.eta, args.rungs)
+    write_table(rows, args.output)
+    best = min(rows, key=lambda row: row["val_log_loss"])
+    print(f"best: trial {best['trial']} " + ", ".join(
+        f"{name}={best[name]}" for name in search_space)
+        + f", val_log_loss {best['val_log_loss']:.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""Per-step timing of training and generation, with profiler trace capture.
+
+When training slows down, the question is whether the GRU is waiting for
+`to_dataset`, computing, or waiting for callbacks (checkpoint I/O, logging).
+`StepTimer` is a Keras callback that times every training step and keeps a
+rolling window of the last `window` steps, summarised as mean, median and
+95th percentile per phase:
+
+* `data_wait`: waiting for the next batch of the input pipeline;
+* `compute`: the forward and backward pass and the weight update;
+* `callbacks`: time between the end of a step and the start of the next,
+  i.e. every other callback's `on_train_batch_end`/`on_train_batch_begin`.
+
+Inside `model.fit`, Keras fetches the batch within the compiled train step,
+so `data_wait` cannot be told apart from `compute` and is folded into it.
+`instrumented_fit` runs the same training step in a loop of its own that
+takes the batch from the dataset iterator first, so all three phases are
+measured:
+
+    timer = StepTimer(log_every=100, summary_path="steps.jsonl",
+                      profile_steps=(200, 210), profile_dir="logs/profile")
+    instrumented_fit(model, train_set, epochs=1, callbacks=[timer])
+
+`profile_steps` captures a `tf.profiler` trace of that step range, to be
+opened in TensorBoard's Profile tab. For generation, `timed_generate` runs
+`StatefulGenerator.sample_and_step` one character at a time and records
+each character's latency in a `LatencyHistogram`.
+
+    python instrumentation.py --steps 300 --profile 100 110
+"""
+
+import argparse
+import collections
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+
+phases = ["data_wait", "compute", "callbacks"]
+
+
+def _summarise(values):
+    values = np.asarray(values) * 1e3
+    return {"mean_ms": float(values.mean()),
+            "p50_ms": float(np.percentile(values, 50)),
+            "p95_ms": float(np.percentile(values, 95))}
+
+
+class StepTimer(tf.keras.callbacks.Callback):
+    """Times each training step by phase (see module doc).
+
+    Every `log_every` steps, the rolling summary is printed and, if
+    `summary_path` is given, appended to that file as a JSON line.
+    """
+
+    def __init__(self, window=100, log_every=100, summary_path=None,
+                 profile_steps=None, profile_dir="logs/profile"):
+        super().__init__()
+        self.steps = collections.deque(maxlen=window)
+        self.log_every = log_every
+        self.summary_path = summary_path
+        self.profile_steps = profile_steps
+        self.profile_dir = profile_dir
+        self.global_step = 0
+        self.data_wait = None  # set by `instrumented_fit` before each step
+        self.step_end = None
+
+    def on_train_batch_begin(self, batch, logs=None):
+        now = time.perf_counter()
+        self.callbacks_time = (0.0 if self.step_end is None else
+                               now - self.step_end - (self.data_wait or 0.0))
+        if self.profile_steps and self.global_step == self.profile_steps[0]:
+            tf.profiler.experimental.start(self.profile_dir)
+        self.step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step_end = time.perf_counter()
+        self.steps.append({
+            "data_wait": self.data_wait or 0.0,
+            "compute": self.step_end - self.step_start,
+            "callbacks": self.callbacks_time})
+        self.data_wait = None
+        if self.profile_steps and self.global_step == self.profile_steps[1]:
+            tf.profiler.experimental.stop()
+        self.global_step += 1
+        if self.global_step % self.log_every == 0:
+            self.log()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.step_end = None  # validation is not callback overhead
+
+    def on_train_end(self, logs=None):
+        if (self.profile_steps
+                and self.profile_steps[0] < self.global_step
+                <= self.profile_steps[1]):
+            tf.profiler.experimental.stop()  # training ended mid-trace
+
+    def summary(self):
+        """Rolling statistics of the last `window` steps, in milliseconds."""
+        if not self.steps:
+            return {}
+        summary = {"step": self.global_step}
+        for phase in phases:
+            summary[phase] = _summarise([step[phase] for step in self.steps])
+        total = sum(summary[phase]["mean_ms"] for phase in phases)
+        for phase in phases:
+            summary[phase]["share"] = (summary[phase]["mean_ms"] / total
+                                       if total else 0.0)
+        return summary
+
+    def log(self):
+        summary = self.summary()
+        print(f"\nstep {summary['step']}: " + ", ".join(
+            f"{phase} {summary[phase]['mean_ms']:.1f} ms "
+            f"({summary[phase]['share']:.0%})" for phase in phases))
+        if self.summary_path:
+            with open(self.summary_path, "a") as f:
+                f.write(json.dumps(summary) + "\n")
+
+
+def instrumented_fit(model, dataset, epochs=1, steps_per_epoch=None,
+                     callbacks=()):
+    """A minimal `model.fit` that tells `StepTimer`s the data-wait time.
+
+    Runs `model.train_step` (compiled with `tf.function`) on each batch of
+    `dataset`, calling the Keras callback hooks like `fit` does: metrics are
+    reset at the start of every epoch, and training stops after the current
+    step once a callback sets `model.stop_training`. Returns the logs of the
+    last step.
+    """
+    callbacks = tf.keras.callbacks.CallbackList(list(callbacks), model=model)
+    timers = [callback for callback in callbacks
+              if isinstance(callback, StepTimer)]
+    train_step = tf.function(model.train_step)
+    logs = {}
+    model.stop_training = False
+    callbacks.on_train_begin(logs)
+    for epoch in range(epochs):
+        model.reset_metrics()
+        callbacks.on_epoch_begin(epoch, logs)
+        batches = iter(dataset)
+        step = 0
+        while ((steps_per_epoch is None or step < steps_per_epoch)
+               and not model.stop_training):
+            start = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                break
+            for timer in timers:
+                timer.data_wait = time.perf_counter() - start
+            callbacks.on_train_batch_begin(step, logs)
+            logs = {name: float(value)  # waits for the step to finish
+                    for name, value in train_step(batch).items()}
+            callbacks.on_train_batch_end(step, logs)
+            step += 1
+        callbacks.on_epoch_end(epoch, logs)
+        if model.stop_training:
+            break
+    callbacks.on_train_end(logs)
+    return logs
+
+
+class LatencyHistogram:
+    """Latencies in log-spaced buckets, from `min_us` microseconds up."""
+
+    def __init__(self, min_us=10, n_buckets=20):
+        self.bounds_us = min_us * 2.0 ** np.arange(n_buckets)
+        self.counts = np.zeros(n_buckets + 1, np.int64)
+        self.latencies = []
+        self.prompt_seconds = None
+
+    def record(self, seconds):
+        self.latencies.append(seconds)
+        self.counts[np.searchsorted(self.bounds_us, seconds * 1e6,
+                                    side="right")] += 1
+
+    def summary(self):
+        if not self.latencies:
+            return {}
+        summary = _summarise(self.latencies)
+        summary["p99_ms"] = float(np.percentile(self.latencies, 99) * 1e3)
+        summary["count"] = len(self.latencies)
+        return summary
+
+    def format(self, width=40):
+        lines = []
+        top = max(self.counts.max(), 1)
+        lows = np.concatenate([[0], self.bounds_us])
+        for low, count in zip(lows, self.counts):
+            if count:
+                bar = "#" * max(1, round(count / top * width))
+                lines.append(f"{low / 1e3:>10.2f} ms+ {count:>8} {bar}")
+        return "\n".join(lines)
+
+
+def timed_generate(generator, prompts, n_chars=50, temperature=1,
+                   histogram=None):
+    """`StatefulGenerator.generate`, timing every generated character.
+
+    Each sampling step is synchronised (its characters are copied to the
+    host) before it is timed. Returns the extended prompts and the
+    `LatencyHistogram`; the prompt's time goes to `histogram.prompt_seconds`.
+    """
+    histogram = histogram or LatencyHistogram()
+    start = time.perf_counter()
+    probas, state = generator.feed_prompts(*generator.encode_batch(prompts))
+    probas.numpy()
+    histogram.prompt_seconds = time.perf_counter() - start
+    options = {"temperature": tf.fill([len(prompts)],
+                                      tf.constant(temperature, tf.float32)),
+               "top_k": tf.constant(0), "top_p": tf.constant(1.0),
+               "repetition_penalty": tf.constant(1.0)}
+    counts = tf.zeros([len(prompts), len(generator.codec)], tf.int32)
+    generated = []
+    for _ in range(n_chars):
+        start = time.perf_counter()
+        char_ids, probas, state, counts = generator.sample_and_step(
+            probas, state, counts, options)
+        generated.append(char_ids.numpy())
+        histogram.record(time.perf_counter() - start)
+    if not generated:
+        return list(prompts), histogram
+    texts = generator.decode_batch(np.stack(generated, axis=1))
+    return [prompt + text for prompt, text in zip(prompts, texts)], histogram
+
+
+def main(argv=None):
+    from char_rnn_model import build_model
+    from text_datasets import load_shakespeare, to_dataset_fast
+    from text_generation import StatefulGenerator
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--steps", type=int, default=300)
+    parser.add_argument("--profile", type=int, nargs=2, metavar=("FIRST",
+                                                                 "LAST"))
+    parser.add_argument("--profile-dir", default="logs/profile")
+    parser.add_argument("--summary", help="append summaries to this file")
+    parser.add_argument("--n-chars", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    text_vec_layer, encoded = load_shakespeare()
+    model = build_model(text_vec_layer.vocabulary_size() - 2)
+    train_set = to_dataset_fast(encoded[:1_000_000], length=100, shuffle=True,
+                                seed=42)
+    timer = StepTimer(log_every=100, summary_path=args.summary,
+                      profile_steps=args.profile,
+                      profile_dir=args.profile_dir)
+    instrumented_fit(model, train_set, steps_per_epoch=args.steps,
+                     callbacks=[timer])
+    generator = StatefulGenerator(model, text_vec_layer)
+    timed_generate(generator, ["To be, or not to be"], 5)  # trace
+    _, histogram = timed_generate(generator, ["To be, or not to be"],
+                                  args.n_chars)
+    print(f"prompt: {histogram.prompt_seconds * 1e3:.1f} ms, per char: "
+          + ", ".join(f"{name} {value:.2f}" for name, value
+                      in histogram.summary().items()))
+    print(histogram.format())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""A registry of text generators with lazy loading and LRU eviction.
+
+We serve several corpus-specific char-RNNs, and loading every SavedModel up
+front does not fit in RAM. `ModelRegistry` discovers the SavedModel
+directories under `root` (any directory holding a `saved_model.pb`, such as
+`my_shakespeare_model` or a distilled `my_shakespeare_model_student_64`)
+without loading them. `get(name)` loads a model on first use and wraps it in
+a `StatefulGenerator`; loaded models are kept in least-recently-used order
+and the least recently used ones are dropped whenever their resident
+memory exceeds `memory_budget` bytes. A model's resident memory is how much
+the process RSS grew while it was loaded and traced: the restored graph and
+functions take more than the weights, and the step model shares layers with
+the loaded model, which keeps its own GRU alive. Loads are measured one at a
+time, and never counted below the bytes of every variable they hold.
+`warm_up` loads (and traces) the most requested models on a background
+thread, so that the first request for them does not pay for the load.
+
+A model directory may hold a `vocabulary.json` (the characters in model ID
+order); models without one use the vocabulary of `text_vec_layer`.
+
+    registry = ModelRegistry(".", text_vec_layer, memory_budget=200 * 2**20)
+    registry.get("my_shakespeare_model").extend_text("To be, or not to be")
+    registry.metrics()  # per model: loads, load time, hits, misses, bytes
+
+    python model_registry.py --root . --budget-mb 200
+"""
+
+import argparse
+import collections
+import gc
+import json
+import os
+import resource
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import tensorflow as tf
+
+from char_codec import CharCodec
+from text_generation import StatefulGenerator
+
+
+def discover(root):
+    """Returns `{name: path}` for the SavedModel directories under `root`."""
+    models = {}
+    for path, dirs, files in os.walk(root):
+        if "saved_model.pb" in files:
+            models[os.path.relpath(path, root)] = path
+            dirs.clear()  # a SavedModel's subdirectories are not models
+    return models
+
+
+def current_rss():
+    """The resident set size of this process in bytes, or None if unknown."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return None
+
+
+def variable_bytes(*models):
+    """Bytes of the distinct variables of `models`."""
+    variables = {id(variable): variable
+                 for model in models for variable in model.variables}
+    return sum(variable.shape.num_elements() * variable.dtype.size
+               for variable in variables.values())
+
+
+class ModelRegistry:
+    def __init__(self, root, text_vec_layer=None, memory_budget=512 * 2**20):
+        self.paths = discover(root)
+        self.text_vec_layer = text_vec_layer
+        self.memory_budget = memory_budget
+        self.loaded = collections.OrderedDict()  # name -> generator, LRU first
+        self.lock = threading.RLock()
+        self.load_locks = collections.defaultdict(threading.Lock)
+        self.measure_lock = threading.Lock()  # one RSS delta at a time
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.stats = {name: {"hits": 0, "misses": 0, "loads": 0,
+                             "evictions": 0, "load_seconds": None,
+                             "resident_bytes": 0, "weight_bytes": 0}
+                      for name in self.paths}
+
+    def names(self):
+        return sorted(self.paths)
+
+    def _codec(self, path):
+        vocab_path = os.path.join(path, "vocabulary.json")
+        if os.path.exists(vocab_path):
+            with open(vocab_path) as f:
+                return CharCodec(json.load(f))
+        if self.text_vec_layer is None:
+            raise ValueError(f"{path} has no vocabulary.json and the registry "
+                             "has no default text_vec_layer")
+        return self.text_vec_layer
+
+    def _load(self, name):
+        with self.measure_lock:
+            gc.collect()
+            rss_before = current_rss()
+            start = time.perf_counter()
+            model = tf.keras.models.load_model(self.paths[name])
+            generator = StatefulGenerator(model,
+                                          self._codec(self.paths[name]))
+            generator.generate([generator.codec.vocabulary[0]],
+                               n_chars=1)  # trace
+            load_seconds = time.perf_counter() - start
+            gc.collect()
+            rss_after = current_rss()
+        weights = variable_bytes(model, generator.step_model)
+        # memory freed by an eviction may be reused, so a delta can be small
+        measured = (0 if rss_before is None or rss_after is None
+                    else rss_after - rss_before)
+        with self.lock:
+            stats = self.stats[name]
+            stats["loads"] += 1
+            stats["load_seconds"] = load_seconds
+            stats["weight_bytes"] = weights
+            stats["resident_bytes"] = max(measured, weights)
+            self.loaded[name] = generator
+            self._evict(keep=name)
+        return generator
+
+    def _evict(self, keep):
+        evicted = False
+        while (len(self.loaded) > 1 and self.resident_total()
+               > self.memory_budget):
+            name = next(name for name in self.loaded if name != keep)
+            del self.loaded[name]
+            self.stats[name]["evictions"] += 1
+            self.stats[name]["resident_bytes"] = 0
+            evicted = True
+        if evicted:
+            gc.collect()  # generators still in use elsewhere stay alive
+
+    def resident_total(self):
+        with self.lock:
+            return sum(self.stats[name]["resident_bytes"]
+                       for name in self.loaded)
+
+    def get(self, name):
+        """Returns the generator for model `name`, loading it if needed."""
+        if name not in self.paths:
+            raise KeyError(f"unknown model {name!r}")
+        with self.lock:
+            if name in self.loaded:
+                self.stats[name]["hits"] += 1
+                self.loaded.move_to_end(name)
+                return self.loaded[name]
+            self.stats[name]["misses"] += 1
+        with self.load_locks[name]:  # one load per model at a time
+            with self.lock:
+                if name in self.loaded:  # loaded by a concurrent call
+                    self.loaded.move_to_end(name)
+                    return self.loaded[name]
+            return self._load(name)
+
+    def popular(self, n):
+        """The `n` most requested models so far."""
+        with self.lock:
+            return sorted(self.paths, key=lambda name: -(
+                self.stats[name]["hits"] + self.stats[name]["misses"]))[:n]
+
+    def warm_up(self, names=None, n=2):
+        """Loads `names` (default: the `n` most popular) in the background.
+
+        Returns the futures of the loads; models that are already loaded are
+        skipped.
+        """
+        names = self.popular(n) if names is None else names
+        with self.lock:
+            names = [name for name in names if name not in self.loaded]
+        return [self.executor.submit(self._warm, name) for name in names]
+
+    def _warm(self, name):
+        with self.load_locks[name]:
+            with self.lock:
+                if name in self.loaded:
+                    return self.loaded[name]
+            return self._load(name)
+
+    def metrics(self):
+        with self.lock:
+            return {name: {**stats, "loaded": name in self.loaded}
+                    for name, stats in self.stats.items()}
+
+
+def main(argv=None):
+    from text_datasets import load_shakespeare
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--root", default=".")
+    parser.add_argument("--budget-mb", type=float, default=512)
+    parser.add_argument("--n-chars", type=int, default=50)
+    args = parser.parse_args(argv)
+
+    text_vec_layer, _ = load_shakespeare()
+    registry = ModelRegistry(args.root, text_vec_layer,
+                             int(args.budget_mb * 2**20))
+    print(f"found {len(registry.paths)} models: {registry.names()}")
+    for name in registry.names() + registry.names():
+        text = registry.get(name).extend_text("To be, or not to be",
+                                              args.n_chars)
+        print(f"{name}: {text!r}")
+    print(json.dumps(registry.metrics(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""Character n-gram language model with interpolated Kneser-Ney smoothing.
+
+A fast statistical baseline (and fallback) for the GRU, trained on the same
+`encoded` text. There are no Python dicts: an n-gram of IDs below `V` (the
+vocabulary size) is packed into one int64, as a base-`V` number whose last
+digit is the most recent character, and every order keeps a sorted array of
+the distinct n-gram keys with their counts, plus a sorted array of the
+distinct contexts with their total count and number of distinct followers.
+Lookups are `np.searchsorted` calls, so scoring a whole text is a handful of
+vectorised passes. The n-grams sharing a context are adjacent in the sorted
+keys, so the next character's distribution costs one search per order.
+
+The highest order uses raw counts, the lower orders continuation counts (in
+how many distinct contexts an n-gram follows one more character), each with
+an absolute discount `D = n1 / (n1 + 2 * n2)`, interpolated down to the
+uniform distribution:
+
+    lm = KneserNeyModel.fit(encoded[:1_000_000], vocabulary, order=7)
+    lm.evaluate(encoded[1_060_000:])        # log-loss, perplexity, accuracy
+    lm.extend_text("To be, or not to be", temperature=0.5)
+
+    python ngram_model.py --order 7
+
+compares test perplexity and generated characters per second with
+`my_shakespeare_model`.
+"""
+
+import argparse
+import math
+import time
+
+import numpy as np
+
+from char_codec import CharCodec
+
+
+def _lookup(keys, values, queries):
+    """`values` of the `queries` found in the sorted `keys`, else 0."""
+    index = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+    return np.where(keys[index] == queries, values[index], 0)
+
+
+def _discount(counts):
+    n1, n2 = np.count_nonzero(counts == 1), np.count_nonzero(counts == 2)
+    return n1 / (n1 + 2 * n2) if n1 else 0.5
+
+
+class KneserNeyModel:
+    def __init__(self, vocabulary, order):
+        self.codec = CharCodec(vocabulary)
+        self.n_tokens = len(vocabulary)
+        self.order = order
+        if self.n_tokens ** order >= 2 ** 63:
+            raise ValueError(f"{order}-grams of {self.n_tokens} characters "
+                             "do not fit in int64 keys")
+        # one entry per n-gram length n = 1 ... order, at index n - 1
+        self.gram_keys, self.gram_counts = [], []
+        self.context_keys, self.context_totals, self.context_types = [], [], []
+        self.discounts = []
+
+    @classmethod
+    def fit(cls, char_ids, vocabulary, order=7):
+        """Counts the n-grams of `char_ids`, up to length `order`."""
+        lm = cls(vocabulary, order)
+        char_ids = np.asarray(char_ids, np.int64)
+        V = lm.n_tokens
+        keys = np.zeros(len(char_ids) + 1, np.int64)
+        gram_keys, raw_counts = [], []
+        for n in range(1, order + 1):  # keys of the n-grams ending at t
+            keys = keys[:-1] * V + char_ids[n - 1:]
+            unique_keys, counts = np.unique(keys, return_counts=True)
+            gram_keys.append(unique_keys)
+            raw_counts.append(counts)
+        for n in range(1, order + 1):
+            if n == order:
+                counts = raw_counts[n - 1]
+            else:  # continuation counts: distinct one-longer left extensions
+                suffixes, suffix_counts = np.unique(gram_keys[n] % V ** n,
+                                                    return_counts=True)
+                # 0 for an n-gram only seen at the very start of the text
+                counts = _lookup(suffixes, suffix_counts, gram_keys[n - 1])
+            contexts, starts = np.unique(gram_keys[n - 1] // V,
+                                         return_index=True)
+            lm.gram_keys.append(gram_keys[n - 1])
+            lm.gram_counts.append(counts)
+            lm.context_keys.append(contexts)
+            lm.context_totals.append(np.add.reduceat(counts, starts))
+            lm.context_types.append(np.add.reduceat(
+                (counts > 0).astype(np.int64), starts))
+            lm.discounts.append(_discount(counts))
+        return lm
+
+    def _interpolate(self, n, context_keys, gram_keys, lower):
+        totals = _lookup(self.context_keys[n - 1], self.context_totals[n - 1],
+                         context_keys)
+        types = _lookup(self.context_keys[n - 1], self.context_types[n - 1],
+                        context_keys)
+        counts = _lookup(self.gram_keys[n - 1], self.gram_counts[n - 1],
+                         gram_keys)
+        discount = self.discounts[n - 1]
+        seen = totals > 0
+        totals = np.where(seen, totals, 1)
+        return np.where(seen, (np.maximum(counts - discount, 0)
+                               + discount * types * lower) / totals, lower)
+
+    def probas(self, context_ids):
+        """Next-character distribution after `context_ids` (any length)."""
+        V = self.n_tokens
+        probas = np.full(V, 1 / V)
+        context_key = 0
+        for n in range(1, self.order + 1):
+            if n > 1:  # prepend the character n - 1 positions back
+                if n - 1 > len(context_ids):
+                    break
+                context_key += int(context_ids[-(n - 1)]) * V ** (n - 2)
+            gram_keys = self.gram_keys[n - 1]
+            start, stop = np.searchsorted(
+                gram_keys, [context_key * V, context_key * V + V])
+            counts = np.zeros(V)
+            counts[gram_keys[start:stop] % V] = (
+                self.gram_counts[n - 1][start:stop])
+            total = counts.sum()
+            if total:
+                discount = self.discounts[n - 1]
+                probas = (np.maximum(counts - discount, 0) + discount
+                          * np.count_nonzero(counts) * probas) / total
+        return probas
+
+    def evaluate(self, char_ids):
+        """Scores every character that has `order - 1` characters before it.
+
+        Returns the mean log-loss per character (in nats), the perplexity and
+        the accuracy of the most likely next character.
+        """
+        char_ids = np.asarray(char_ids, np.int64)
+        V, first = self.n_tokens, self.order - 1
+        targets = char_ids[first:]
+        probas = np.full(len(targets), 1 / V)
+        context_keys = np.zeros(len(targets), np.int64)
+        for n in range(1, self.order + 1):
+            if n > 1:  # prepend the character n - 1 positions back
+                context_keys += char_ids[first - (n - 1):len(char_ids)
+                                         - (n - 1)] * V ** (n - 2)
+            probas = self._interpolate(n, context_keys,
+                                       context_keys * V + targets, probas)
+        log_loss = float(-np.log(probas).mean())
+        # the argmax needs the whole distribution: sample 2,000 positions
+        sample = np.linspace(first, len(char_ids) - 1, 2_000, dtype=np.int64)
+        correct = [self.probas(char_ids[t - first:t]).argmax() == char_ids[t]
+                   for t in sample]
+        return {"log_loss": log_loss, "perplexity": math.exp(log_loss),
+                "accuracy": float(np.mean(correct))}
+
+    def extend_text(self, text, n_chars=50, temperature=1, seed=None):
+        """Same contract as the notebook's `extend_text`."""
+        rng = np.random.default_rng(seed)
+        char_ids = list(self.codec.encode(text)[-(self.order - 1):])
+        generated = []
+        for _ in range(n_chars):
+            logits = np.log(self.probas(char_ids[-(self.order - 1):]))
+            gumbel = -np.log(-np.log(rng.uniform(size=self.n_tokens)))
+            char_id = int(np.argmax(logits / temperature + gumbel))
+            char_ids.append(char_id)
+            generated.append(char_id)
+        return text + self.codec.decode(generated)
+
+    def nbytes(self):
+        return sum(array.nbytes for arrays in [
+            self.gram_keys, self.gram_counts, self.context_keys,
+            self.context_totals, self.context_types] for array in arrays)
+
+
+def main(argv=None):
+    import tensorflow as tf
+
+    from evaluation import StatefulEvaluator
+    from text_datasets import load_shakespeare
+    from text_generation import StatefulGenerator
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--order", type=int, default=7)
+    parser.add_argument("--model-dir", default="my_shakespeare_model")
+    parser.add_argument("--n-chars", type=int, default=500)
+    args = parser.parse_args(argv)
+
+    text_vec_layer, encoded = load_shakespeare()
+    encoded = encoded.numpy()
+    vocabulary = text_vec_layer.get_vocabulary()[2:]
+    start = time.perf_counter()
+    lm = KneserNeyModel.fit(encoded[:1_000_000], vocabulary, args.order)
+    print(f"{args.order}-gram model: fitted in "
+          f"{time.perf_counter() - start:.1f}s, {lm.nbytes() / 2**20:.1f} MB")
+    model = tf.keras.models.load_model(args.model_dir)
+    test_ids = encoded[1_060_000:]
+    generator = StatefulGenerator(model, text_vec_layer)
+    generator.extend_text("To be", n_chars=5)  # trace
+    contenders = {
+        f"{args.order}-gram": (lm.evaluate, lm.extend_text),
+        "GRU": (StatefulEvaluator(model).evaluate, generator.extend_text)}
+    for name, (evaluate, extend_text) in contenders.items():
+        scores = evaluate(test_ids)
+        start = time.perf_counter()
+        extend_text("To be, or not to be", n_chars=args.n_chars)
+        chars_per_s = args.n_chars / (time.perf_counter() - start)
+        print(f"{name:>8}: test perplexity {scores['perplexity']:.3f}, "
+              f"accuracy {scores['accuracy']:.4f}, "
+              f"{chars_per_s:,.0f} generated chars/s")
+
+
+if __name__ == "__main__":
+    main()
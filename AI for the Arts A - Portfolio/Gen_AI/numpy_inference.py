@@ -0,0 +1,183 @@
+"""A NumPy-only runtime for the saved `my_shakespeare_model`.
+
+Loading the SavedModel needs TensorFlow, which takes seconds and hundreds of MB
+before the first character comes out. `export_npz` (which does use
+TensorFlow) pulls the Embedding, GRU and Dense weights plus the vocabulary out
+into a small `.npz` file once; `NumpyCharRNN` then runs the GRU steps, the
+softmax and the sampling with NumPy alone.
+
+    python numpy_inference.py export      # my_shakespeare_model -> .npz
+    python numpy_inference.py generate "To be, or not to be" --temperature 1
+    python numpy_inference.py check       # compare with the Keras model
+
+The GRU follows Keras' `reset_after=True` formulation (the TF2 default the
+notebook trained with), with the update, reset and candidate gates stored in
+that order in the kernels.
+"""
+
+import argparse
+import resource
+import sys
+import time
+
+import numpy as np
+
+from char_codec import CharCodec
+
+default_model_dir = "my_shakespeare_model"
+default_npz_path = "my_shakespeare_model.npz"
+
+
+def export_npz(model, vocabulary, path=default_npz_path):
+    """Saves the weights of the trained char-RNN `model` to `path`.
+
+    `vocabulary` is `text_vec_layer.get_vocabulary()[2:]`, i.e. the
+    characters in model ID order, without the pad and unknown tokens.
+    """
+    embedding, gru, dense = model.layers
+    if not gru.reset_after:
+        raise ValueError("only GRU layers with reset_after=True are supported")
+    kernel, recurrent_kernel, bias = gru.get_weights()
+    dense_kernel, dense_bias = dense.get_weights()
+    np.savez_compressed(
+        path,
+        embeddings=embedding.get_weights()[0],
+        kernel=kernel, recurrent_kernel=recurrent_kernel, bias=bias,
+        dense_kernel=dense_kernel, dense_bias=dense_bias,
+        vocabulary=np.array(vocabulary))
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def log_softmax(logits):
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    return logits - np.log(np.exp(logits).sum(axis=-1, keepdims=True))
+
+
+class NumpyCharRNN:
+    """Embedding -> GRU -> Dense(softmax), one time step at a time."""
+
+    def __init__(self, embeddings, kernel, recurrent_kernel, bias,
+                 dense_kernel, dense_bias, vocabulary):
+        self.units = recurrent_kernel.shape[0]
+        input_bias, self.recurrent_bias = bias
+        # an embedding lookup followed by the GRU input projection is just a
+        # lookup in their product, so fold them into one table
+        self.input_table = embeddings @ kernel + input_bias
+        self.recurrent_kernel = recurrent_kernel
+        self.dense_kernel = dense_kernel
+        self.dense_bias = dense_bias
+        self.codec = CharCodec(vocabulary)
+
+    @classmethod
+    def load(cls, path=default_npz_path):
+        with np.load(path) as weights:
+            return cls(**{name: weights[name] for name in weights.files})
+
+    def initial_state(self, batch_size=1):
+        return np.zeros([batch_size, self.units], np.float32)
+
+    def encode(self, text):
+        return self.codec.encode(text)
+
+    def decode(self, char_ids):
+        return self.codec.decode(char_ids)
+
+    def step(self, char_ids, state):
+        """Advances the GRU by one character per row; returns the new state."""
+        x_z, x_r, x_h = np.split(self.input_table[char_ids], 3, axis=-1)
+        h_proj = state @ self.recurrent_kernel + self.recurrent_bias
+        h_z, h_r, h_h = np.split(h_proj, 3, axis=-1)
+        z = sigmoid(x_z + h_z)
+        r = sigmoid(x_r + h_r)
+        candidate = np.tanh(x_h + r * h_h)
+        return z * state + (1 - z) * candidate
+
+    def log_probas(self, state):
+        return log_softmax(state @ self.dense_kernel + self.dense_bias)
+
+    def feed(self, char_ids, state=None):
+        """Runs `char_ids` (shape [batch, steps]) through the GRU."""
+        char_ids = np.atleast_2d(char_ids)
+        if state is None:
+            state = self.initial_state(len(char_ids))
+        for t in range(char_ids.shape[1]):
+            state = self.step(char_ids[:, t], state)
+        return state
+
+    def sample(self, log_probas, temperature=1, rng=None):
+        """Draws one ID per row from `softmax(log_probas / temperature)`."""
+        rng = np.random.default_rng() if rng is None else rng
+        gumbel = -np.log(-np.log(rng.uniform(size=log_probas.shape)))
+        return np.argmax(log_probas / temperature + gumbel, axis=-1)
+
+    def extend_text(self, text, n_chars=50, temperature=1, seed=None):
+        """Same contract as the notebook's `extend_text`."""
+        rng = np.random.default_rng(seed)
+        state = self.feed(self.encode(text)[np.newaxis])
+        generated = []
+        for _ in range(n_chars):
+            char_id = self.sample(self.log_probas(state), temperature, rng)
+            generated.append(char_id[0])
+            state = self.step(char_id, state)
+        return text + self.decode(np.array(generated, np.int32))
+
+
+def check(model_dir=default_model_dir, npz_path=default_npz_path,
+          text="To be, or not to be"):
+    """Returns the largest difference between Keras and NumPy probabilities."""
+    import tensorflow as tf
+
+    model = tf.keras.models.load_model(model_dir)
+    runtime = NumpyCharRNN.load(npz_path)
+    char_ids = runtime.encode(text)[np.newaxis]
+    expected = model.predict(char_ids, verbose=0)[0]
+    state, actual = runtime.initial_state(), []
+    for char_id in char_ids[0]:
+        state = runtime.step(np.array([char_id]), state)
+        actual.append(np.exp(runtime.log_probas(state))[0])
+    return float(np.abs(expected - np.array(actual)).max())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export")
+    export_parser.add_argument("--model-dir", default=default_model_dir)
+    export_parser.add_argument("--output", default=default_npz_path)
+    generate_parser = subparsers.add_parser("generate")
+    generate_parser.add_argument("text")
+    generate_parser.add_argument("--n-chars", type=int, default=50)
+    generate_parser.add_argument("--temperature", type=float, default=1)
+    generate_parser.add_argument("--seed", type=int)
+    generate_parser.add_argument("--npz", default=default_npz_path)
+    check_parser = subparsers.add_parser("check")
+    check_parser.add_argument("--model-dir", default=default_model_dir)
+    check_parser.add_argument("--npz", default=default_npz_path)
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        import tensorflow as tf
+        from text_datasets import load_shakespeare
+
+        text_vec_layer, _ = load_shakespeare()
+        export_npz(tf.keras.models.load_model(args.model_dir),
+                   text_vec_layer.get_vocabulary()[2:], args.output)
+    elif args.command == "generate":
+        start = time.perf_counter()
+        runtime = NumpyCharRNN.load(args.npz)
+        print(runtime.extend_text(args.text, args.n_chars, args.temperature,
+                                  args.seed))
+        print(f"total {time.perf_counter() - start:.3f}s (after imports), "
+              f"peak RSS "
+              f"{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f}"
+              f" MB", file=sys.stderr)
+    else:
+        print(f"max |Keras - NumPy| probability difference: "
+              f"{check(args.model_dir, args.npz):.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""A cache of GRU hidden states for prompts that share prefixes.
+
+Many prompts start the same way (the same opening line with different
+continuations), yet every call runs the GRU over the whole prompt again. The
+GRU's hidden state after a prefix summarises that prefix completely, so
+`PrefixStateCache` stores it, together with the next-character
+probabilities, in a trie keyed on the encoded prefix. A lookup walks the trie
+along the new prompt and returns the deepest cached state; only the rest of
+the prompt then goes through the GRU. Entries are evicted least recently used
+first once the cache outgrows its memory budget.
+
+    generator = CachedGenerator(StatefulGenerator(model, text_vec_layer))
+    generator.cache_prefixes(["To be, or not to be, that is the question:"])
+    generator.generate(["To be, or not to be, that is the question: wh",
+                        "To be, or not to be, that is the question: 'ti"])
+    generator.cache.metrics()
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+import tensorflow as tf
+
+NODE_BYTES = 200  # rough size of one trie node in CPython
+
+
+class _Node:
+    __slots__ = ("parent", "char_id", "children", "entry")
+
+    def __init__(self, parent=None, char_id=None):
+        self.parent = parent
+        self.char_id = char_id
+        self.children = {}
+        self.entry = None  # (state, probas) once this prefix is cached
+
+
+class PrefixStateCache:
+    def __init__(self, max_bytes=64 * 2**20):
+        self.max_bytes = max_bytes
+        self.root = _Node()
+        self.lru = OrderedDict()  # node -> entry size, least recent first
+        self.n_nodes = 0
+        self.entry_bytes = 0
+        self.counters = {"lookups": 0, "hits": 0, "saved_steps": 0,
+                         "computed_steps": 0, "evictions": 0}
+
+    @property
+    def nbytes(self):
+        return self.entry_bytes + self.n_nodes * NODE_BYTES
+
+    def __len__(self):
+        return len(self.lru)
+
+    def lookup(self, char_ids):
+        """Returns `(length, state, probas)` for the longest cached prefix.
+
+        Returns `(0, None, None)` if no prefix of `char_ids` is cached.
+        """
+        node, best, best_length = self.root, None, 0
+        for length, char_id in enumerate(char_ids, start=1):
+            node = node.children.get(int(char_id))
+            if node is None:
+                break
+            if node.entry is not None:
+                best, best_length = node, length
+        self.counters["lookups"] += 1
+        self.counters["saved_steps"] += best_length
+        self.counters["computed_steps"] += len(char_ids) - best_length
+        if best is None:
+            return 0, None, None
+        self.counters["hits"] += 1
+        self.lru.move_to_end(best)
+        return (best_length, *best.entry)
+
+    def insert(self, char_ids, state, probas):
+        """Caches the GRU `state` and next-character `probas` after
+        `char_ids`, then evicts old entries if over budget."""
+        node = self.root
+        for char_id in char_ids:
+            parent, char_id = node, int(char_id)
+            node = parent.children.get(char_id)
+            if node is None:
+                node = parent.children[char_id] = _Node(parent, char_id)
+                self.n_nodes += 1
+        if node.entry is not None:
+            self.entry_bytes -= self.lru.pop(node)
+        node.entry = (np.array(state, np.float32),
+                      np.array(probas, np.float32))
+        size = node.entry[0].nbytes + node.entry[1].nbytes
+        self.lru[node] = size
+        self.entry_bytes += size
+        while self.nbytes > self.max_bytes and self.lru:
+            self._evict_oldest()
+
+    def _evict_oldest(self):
+        node, size = self.lru.popitem(last=False)
+        node.entry = None
+        self.entry_bytes -= size
+        self.counters["evictions"] += 1
+        # drop the branch of the trie that no longer leads to any entry
+        while (node is not self.root and not node.children
+               and node.entry is None):
+            del node.parent.children[node.char_id]
+            self.n_nodes -= 1
+            node = node.parent
+
+    def metrics(self):
+        lookups = self.counters["lookups"]
+        total_steps = (self.counters["saved_steps"]
+                       + self.counters["computed_steps"])
+        return {**self.counters,
+                "hit_rate": self.counters["hits"] / lookups if lookups else 0,
+                "saved_step_fraction": (self.counters["saved_steps"]
+                                        / total_steps if total_steps else 0),
+                "entries": len(self), "nbytes": self.nbytes}
+
+
+class CachedGenerator:
+    """Wraps a `StatefulGenerator` so that prompt passes use the cache."""
+
+    def __init__(self, generator, cache=None):
+        self.generator = generator
+        self.cache = PrefixStateCache() if cache is None else cache
+
+    def prime(self, prompts):
+        """Returns `(probas, state)` after each prompt, like `feed_prompts`.
+
+        Each prompt resumes from its longest cached prefix; prompts with the
+        same number of uncached characters go through the GRU together. The
+        state after every full prompt is then cached.
+        """
+        encoded = [self.generator.encode(prompt) for prompt in prompts]
+        hits = [self.cache.lookup(char_ids) for char_ids in encoded]
+        probas, states = [None] * len(prompts), [None] * len(prompts)
+        buckets = {}
+        for row, (char_ids, (length, state, row_probas)) in enumerate(
+                zip(encoded, hits)):
+            if length == len(char_ids):
+                probas[row], states[row] = row_probas, state
+            else:
+                buckets.setdefault(len(char_ids) - length, []).append(row)
+        for suffix_length, rows in buckets.items():
+            start = np.stack([
+                hits[row][1] if hits[row][1] is not None
+                else np.zeros(self.generator.units, np.float32)
+                for row in rows])
+            suffixes = np.stack([encoded[row][-suffix_length:]
+                                 for row in rows])
+            bucket_probas, bucket_state = self.generator.feed(suffixes, start)
+            for row, row_probas, state in zip(rows, bucket_probas.numpy(),
+                                              bucket_state.numpy()):
+                probas[row], states[row] = row_probas, state
+                self.cache.insert(encoded[row], state, row_probas)
+        return tf.constant(np.stack(probas)), tf.constant(np.stack(states))
+
+    def cache_prefixes(self, prefixes):
+        """Warms the cache with the states after each of `prefixes`."""
+        self.prime(list(prefixes))
+
+    def generate(self, prompts, n_chars=50, **kwargs):
+        """`StatefulGenerator.generate`, with cached prompt passes."""
+        prompts = list(prompts)
+        if not prompts:
+            return []
+        return self.generator.generate(prompts, n_chars,
+                                       prompt_states=self.prime(prompts),
+                                       **kwargs)
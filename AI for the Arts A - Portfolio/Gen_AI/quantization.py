@@ -0,0 +1,179 @@
+"""Int8 post-training quantization of the char-RNN for CPU inference.
+
+The trained model is re-expressed as a single GRU step (embedding lookup, the
+`reset_after=True` GRU cell equations and the softmax output layer) and
+converted with the TensorFlow Lite converter twice: once in float32, and once
+with full integer quantization. The latter stores the Embedding, GRU and
+Dense weights as int8 with per-channel scales and calibrates the activation
+ranges by running the float step statefully over part of the validation text
+(the characters behind `valid_set`). `TFLiteStepRunner` is the matching
+inference runtime for both.
+
+    python quantization.py --calibration-chars 20000
+
+prints the model sizes, the per-step CPU latency and the log-loss, perplexity
+and accuracy over the test text (the characters behind `test_set`) for the
+float32 and int8 models, so the trade-off can be judged before deploying.
+"""
+
+import argparse
+import math
+import os
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+
+class GRUStep(tf.Module):
+    """One step of a trained char-RNN, with the GRU state as input/output."""
+
+    def __init__(self, model, batch_size=1):
+        super().__init__()
+        embedding, gru, dense = model.layers
+        if not gru.reset_after:
+            raise ValueError("only GRU layers with reset_after=True are "
+                             "supported")
+        self.embeddings = tf.constant(embedding.get_weights()[0])
+        kernel, recurrent_kernel, bias = gru.get_weights()
+        self.kernel = tf.constant(kernel)
+        self.recurrent_kernel = tf.constant(recurrent_kernel)
+        self.input_bias, self.recurrent_bias = tf.unstack(tf.constant(bias))
+        dense_kernel, dense_bias = dense.get_weights()
+        self.dense_kernel = tf.constant(dense_kernel)
+        self.dense_bias = tf.constant(dense_bias)
+        self.units = gru.units
+        self.step = tf.function(self.step, input_signature=[
+            tf.TensorSpec([batch_size], tf.int32, name="char_ids"),
+            tf.TensorSpec([batch_size, gru.units], tf.float32, name="state")])
+
+    def step(self, char_ids, state):
+        inputs = tf.gather(self.embeddings, char_ids)
+        x_z, x_r, x_h = tf.split(inputs @ self.kernel + self.input_bias, 3,
+                                 axis=-1)
+        h_z, h_r, h_h = tf.split(
+            state @ self.recurrent_kernel + self.recurrent_bias, 3, axis=-1)
+        z = tf.sigmoid(x_z + h_z)
+        r = tf.sigmoid(x_r + h_r)
+        state = z * state + (1 - z) * tf.tanh(x_h + r * h_h)
+        probas = tf.nn.softmax(state @ self.dense_kernel + self.dense_bias)
+        return {"probas": probas, "state": state}
+
+
+def calibration_samples(gru_step, char_ids, batch_size=1):
+    """Yields `[char_ids, state]` inputs seen while reading `char_ids`."""
+    state = tf.zeros([batch_size, gru_step.units])
+    for char_id in char_ids:
+        inputs = tf.fill([batch_size], tf.cast(char_id, tf.int32))
+        yield [inputs, state]
+        state = gru_step.step(inputs, state)["state"]
+
+
+def convert(model, calibration_ids=None, batch_size=1):
+    """Returns the TFLite flatbuffer of the GRU step of `model`.
+
+    With `calibration_ids`, the model is fully int8-quantized, with activation
+    ranges calibrated on those characters; otherwise it stays float32.
+    """
+    gru_step = GRUStep(model, batch_size)
+    with tempfile.TemporaryDirectory() as saved_model_dir:
+        tf.saved_model.save(gru_step, saved_model_dir, signatures={
+            "step": gru_step.step.get_concrete_function()})
+        converter = tf.lite.TFLiteConverter.from_saved_model(
+            saved_model_dir, signature_keys=["step"])
+        if calibration_ids is not None:
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = lambda: calibration_samples(
+                gru_step, calibration_ids, batch_size)
+            converter.target_spec.supported_ops = [
+                tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        return converter.convert()
+
+
+class TFLiteStepRunner:
+    """Runs a GRU step produced by `convert` (float32 or int8)."""
+
+    def __init__(self, tflite_model):
+        self.interpreter = tf.lite.Interpreter(model_content=tflite_model)
+        self.runner = self.interpreter.get_signature_runner("step")
+        state_details = self.runner.get_input_details()["state"]
+        self.batch_size, self.units = state_details["shape"]
+
+    def initial_state(self):
+        return np.zeros([self.batch_size, self.units], np.float32)
+
+    def step(self, char_ids, state):
+        outputs = self.runner(char_ids=np.asarray(char_ids, np.int32),
+                              state=state)
+        return outputs["probas"], outputs["state"]
+
+    def evaluate(self, char_ids):
+        """Scores `char_ids` in one stateful pass (one stream per batch row).
+
+        Returns the mean log-loss per character (in nats), the perplexity and
+        the accuracy of the most likely next character.
+        """
+        char_ids = np.asarray(char_ids)
+        n_steps = len(char_ids) // self.batch_size
+        streams = char_ids[:n_steps * self.batch_size].reshape(
+            self.batch_size, n_steps)
+        state, total_loss, n_correct = self.initial_state(), 0.0, 0
+        for t in range(n_steps - 1):
+            probas, state = self.step(streams[:, t], state)
+            targets = streams[:, t + 1]
+            target_probas = probas[np.arange(self.batch_size), targets]
+            total_loss -= np.log(np.maximum(target_probas, 1e-12)).sum()
+            n_correct += (probas.argmax(axis=-1) == targets).sum()
+        n_scored = (n_steps - 1) * self.batch_size
+        log_loss = total_loss / n_scored
+        return {"log_loss": log_loss, "perplexity": math.exp(log_loss),
+                "accuracy": n_correct / n_scored}
+
+    def step_latency_us(self, n_steps=2000):
+        state = self.initial_state()
+        char_ids = np.zeros(self.batch_size, np.int32)
+        self.step(char_ids, state)  # warm up
+        start = time.perf_counter()
+        for _ in range(n_steps):
+            _, state = self.step(char_ids, state)
+        return (time.perf_counter() - start) / n_steps * 1e6
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+
+def main(argv=None):
+    from text_datasets import load_shakespeare
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model-dir", default="my_shakespeare_model")
+    parser.add_argument("--calibration-chars", type=int, default=20_000)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--output", default="my_shakespeare_model_int8.tflite")
+    args = parser.parse_args(argv)
+
+    _, encoded = load_shakespeare()
+    encoded = encoded.numpy()
+    model = tf.keras.models.load_model(args.model_dir)
+    calibration_ids = encoded[1_000_000:1_000_000 + args.calibration_chars]
+    test_ids = encoded[1_060_000:]
+    float_model = convert(model, batch_size=args.batch_size)
+    int8_model = convert(model, calibration_ids, args.batch_size)
+    with open(args.output, "wb") as f:
+        f.write(int8_model)
+
+    print(f"SavedModel: {directory_size(args.model_dir):>10,} bytes")
+    for name, tflite_model in [("float32", float_model), ("int8", int8_model)]:
+        runner = TFLiteStepRunner(tflite_model)
+        scores = runner.evaluate(test_ids)
+        print(f"{name:>10}: {len(tflite_model):>10,} bytes, "
+              f"{runner.step_latency_us():7.1f} µs/step, test log-loss "
+              f"{scores['log_loss']:.4f}, perplexity "
+              f"{scores['perplexity']:.3f}, accuracy {scores['accuracy']:.4f}")
+
+
+if __name__ == "__main__":
+    main()
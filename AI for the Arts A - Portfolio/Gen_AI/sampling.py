@@ -0,0 +1,171 @@
+"""Vectorised sampling kernels for the char-RNN generators.
+
+The notebook's `next_char` takes the log of the softmax output, divides it by
+the temperature and draws one sample with `tf.random.categorical`. The
+functions below work on a whole batch of logits, shape [batch, n_tokens],
+with a temperature, top-k, top-p and repetition penalty that may differ per
+row, and sample with the Gumbel-max trick: `argmax(logits + Gumbel noise)` is
+a draw from `softmax(logits)`. Everything is plain TensorFlow ops (one sort,
+one cumulative sum and one argmax per step, however many rows there are), so
+it can run inside the generators' `tf.function`s.
+
+    char_ids = sample(logits, temperature=[0.5, 1.0], top_k=10, top_p=0.9)
+"""
+
+import numpy as np
+import tensorflow as tf
+
+
+def _per_row(value, logits, dtype):
+    """Broadcasts a scalar or per-row `value` to shape [batch, 1]."""
+    value = tf.cast(value, dtype)
+    return tf.broadcast_to(tf.reshape(value, [-1, 1]),
+                           [tf.shape(logits)[0], 1])
+
+
+def apply_repetition_penalty(logits, counts, penalty):
+    """Penalises tokens with `counts > 0`, CTRL-style.
+
+    Positive logits of already generated tokens are divided by `penalty` and
+    negative ones multiplied by it, so `penalty > 1` always makes repeats
+    less likely. `counts` has the same shape as `logits`.
+    """
+    penalty = _per_row(penalty, logits, logits.dtype)
+    penalised = tf.where(logits > 0, logits / penalty, logits * penalty)
+    return tf.where(counts > 0, penalised, logits)
+
+
+def filter_top_k_top_p(logits, top_k=0, top_p=1.0):
+    """Sets to -inf the logits outside each row's top-k and top-p sets.
+
+    `top_k=0` and `top_p=1` disable the corresponding filter. Both filters
+    share a single descending sort of the logits.
+    """
+    n_tokens = tf.shape(logits)[-1]
+    sorted_logits = tf.sort(logits, axis=-1, direction="DESCENDING")
+    top_k = _per_row(top_k, logits, tf.int32)
+    top_k = tf.where(top_k > 0, tf.minimum(top_k, n_tokens), n_tokens)
+    # nucleus: the smallest prefix whose probability mass reaches top_p
+    cumulative_before = tf.cumsum(tf.nn.softmax(sorted_logits), axis=-1,
+                                  exclusive=True)
+    in_nucleus = cumulative_before < _per_row(top_p, logits, logits.dtype)
+    top_p_size = tf.reduce_sum(tf.cast(in_nucleus, tf.int32), axis=-1,
+                               keepdims=True)
+    n_kept = tf.maximum(tf.minimum(top_k, top_p_size), 1)
+    threshold = tf.gather(sorted_logits, n_kept - 1, batch_dims=1)
+    return tf.where(logits < threshold, tf.constant(-np.inf, logits.dtype),
+                    logits)
+
+
+_mask32 = 0xFFFFFFFF
+
+
+def _hash32(x):
+    """Mixes the 32-bit values of int64 tensor `x` (an integer hash).
+
+    The multipliers are below 2**31, so no product overflows int64.
+    """
+    x = tf.bitwise.bitwise_xor(x, tf.bitwise.right_shift(x, 16))
+    x = tf.bitwise.bitwise_and(x * 0x7feb352d, _mask32)
+    x = tf.bitwise.bitwise_xor(x, tf.bitwise.right_shift(x, 15))
+    x = tf.bitwise.bitwise_and(x * 0x2c1b3c6d, _mask32)
+    return tf.bitwise.bitwise_xor(x, tf.bitwise.right_shift(x, 16))
+
+
+def counter_noise(row_seeds, n_columns):
+    """Uniform noise in (0, 1), shape [batch, n_columns], from per-row seeds.
+
+    Counter-based: each value is a hash of its row's seed pair and its
+    column, so a row's noise depends on nothing else, and the whole batch
+    is a few elementwise ops.
+    """
+    row_seeds = tf.cast(row_seeds, tf.int64)
+    key = tf.zeros_like(row_seeds[:, :1])
+    for word in (row_seeds[:, :1], row_seeds[:, 1:]):
+        for shift in (0, 32):
+            key = _hash32(tf.bitwise.bitwise_xor(key, tf.bitwise.bitwise_and(
+                tf.bitwise.right_shift(word, shift), _mask32)))
+    columns = tf.range(tf.cast(n_columns, tf.int64), dtype=tf.int64)
+    bits = _hash32(tf.bitwise.bitwise_and(key + columns * 0x9e3779b9,
+                                          _mask32))
+    bits = _hash32(tf.bitwise.bitwise_xor(bits, key))
+    # the top 24 bits, centred in their interval: exact in float32, never 0
+    return (tf.cast(tf.bitwise.right_shift(bits, 8), tf.float32)
+            + 0.5) / 2.0 ** 24
+
+
+def uniform_noise(shape, row_seeds=None, generator=None):
+    """Uniform noise in (0, 1) for Gumbel-max sampling.
+
+    With `row_seeds` (shape [batch, 2]), each row gets its own stateless
+    stream (see `counter_noise`), so a row's samples do not depend on the
+    rest of the batch; all rows are still drawn at once. Otherwise the whole
+    batch is drawn in one op, from `generator` if given, else from the
+    global seed.
+    """
+    minval = np.finfo(np.float32).tiny
+    if row_seeds is not None:
+        return counter_noise(row_seeds, shape[1])
+    if generator is not None:
+        return generator.uniform(shape, minval=minval)
+    return tf.random.uniform(shape, minval=minval)
+
+
+def gumbel_max(logits, noise):
+    """Returns `argmax(logits + Gumbel(noise))` per row, as int32."""
+    gumbel = -tf.math.log(-tf.math.log(noise))
+    return tf.argmax(logits + gumbel, axis=-1, output_type=tf.int32)
+
+
+def sample(logits, temperature=1.0, top_k=0, top_p=1.0, counts=None,
+           repetition_penalty=1.0, row_seeds=None, generator=None):
+    """Draws one token ID per row of `logits`.
+
+    Every option is either a scalar or one value per row. `counts`, the
+    number of times each token was already generated in each row, is only
+    needed for `repetition_penalty`.
+    """
+    logits = tf.convert_to_tensor(logits, tf.float32)
+    if counts is not None:
+        logits = apply_repetition_penalty(logits, counts, repetition_penalty)
+    logits /= _per_row(temperature, logits, tf.float32)
+    logits = filter_top_k_top_p(logits, top_k, top_p)
+    noise = uniform_noise(tf.shape(logits), row_seeds, generator)
+    return gumbel_max(logits, noise)
+
+
+def benchmark(batch_sizes=(1, 64, 1024, 4096), n_tokens=39, units=128,
+              number=50):
+    """Times `sample` against one GRU(units) step at several batch sizes.
+
+    Returns `{batch_size: (sample_ms, gru_step_ms)}`.
+    """
+    import timeit
+
+    gru = tf.keras.layers.GRU(units, return_state=True)
+    sample_fn = tf.function(
+        lambda logits, counts: sample(logits, 0.8, top_k=10, top_p=0.9,
+                                      counts=counts, repetition_penalty=1.2))
+    step_fn = tf.function(lambda inputs, state: gru(inputs,
+                                                    initial_state=state))
+    results = {}
+    for batch_size in batch_sizes:
+        logits = tf.random.normal([batch_size, n_tokens])
+        counts = tf.random.uniform([batch_size, n_tokens], maxval=3,
+                                   dtype=tf.int32)
+        inputs = tf.random.normal([batch_size, 1, 16])
+        state = tf.zeros([batch_size, units])
+        timings = []
+        for fn, args in [(sample_fn, (logits, counts)),
+                         (step_fn, (inputs, state))]:
+            fn(*args)  # trace
+            timings.append(timeit.timeit(lambda: fn(*args), number=number)
+                           / number * 1e3)
+        results[batch_size] = tuple(timings)
+    return results
+
+
+if __name__ == "__main__":
+    for batch_size, (sample_ms, step_ms) in benchmark().items():
+        print(f"batch {batch_size:>5}: sample {sample_ms:7.3f} ms, "
+              f"GRU step {step_ms:7.3f} ms")
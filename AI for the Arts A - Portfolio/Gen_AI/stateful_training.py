@@ -0,0 +1,176 @@
+"""Stateful truncated-BPTT training for the Shakespeare char-RNN.
+
+The notebook's `to_dataset` uses `shift=1`, so each epoch runs the GRU over
+~1M overlapping 100-character windows: about 100 GRU time steps per character
+of the corpus. Here the training text is cut into `batch_size` contiguous
+streams, and batch `i` holds the `i`-th non-overlapping window of every
+stream. A `stateful=True` GRU then carries its hidden state from one window to
+the next, so it still learns from context longer than one window, while each
+epoch costs one GRU time step per character. States are reset once per epoch.
+
+Both modes report GRU time steps (tokens) per second and validation accuracy
+against wall-clock minutes, so time-to-accuracy can be compared directly:
+
+    python stateful_training.py --mode stateful --epochs 10
+    python stateful_training.py --mode baseline --epochs 2
+"""
+
+import argparse
+import json
+import time
+
+import tensorflow as tf
+
+from char_rnn_model import build_model, model_dims
+from text_datasets import load_shakespeare, to_dataset, to_dataset_fast
+
+
+def to_stateful_dataset(sequence, length, batch_size=32):
+    """Non-overlapping (X, Y) windows from `batch_size` contiguous streams.
+
+    Row `r` of consecutive batches continues the same stream, which is what a
+    stateful GRU expects. The batches must not be shuffled.
+    """
+    sequence = tf.convert_to_tensor(sequence)
+    n_steps = tf.size(sequence) // batch_size
+    n_windows = (n_steps - 1) // length
+    streams = tf.reshape(sequence[:n_steps * batch_size],
+                         [batch_size, n_steps])
+
+    def windows(offset):
+        chunk = streams[:, offset:offset + n_windows * length]
+        chunk = tf.reshape(chunk, [batch_size, n_windows, length])
+        return tf.transpose(chunk, [1, 0, 2])  # [n_windows, batch, length]
+
+    ds = tf.data.Dataset.from_tensor_slices((windows(0), windows(1)))
+    return ds.prefetch(tf.data.AUTOTUNE)
+
+
+class ResetStatesCallback(tf.keras.callbacks.Callback):
+    def on_epoch_begin(self, epoch, logs):
+        self.model.reset_states()
+
+
+class TimeToAccuracy(tf.keras.callbacks.Callback):
+    """Logs tokens/s and validation accuracy against wall-clock time.
+
+    `tokens_per_batch` is the number of GRU time steps in one training
+    batch. If `evaluate` is given, it is called with the model at the end of
+    each epoch and must return the validation accuracy; otherwise the
+    `val_accuracy` computed by `fit` is used. Tokens/s is measured up to the
+    end of the epoch's last training batch, so it leaves out validation in
+    both cases (`fit` validates before `on_epoch_end`).
+    """
+
+    def __init__(self, tokens_per_batch, evaluate=None):
+        super().__init__()
+        self.tokens_per_batch = tokens_per_batch
+        self.evaluate = evaluate
+        self.rows = []
+
+    def on_train_begin(self, logs=None):
+        self.train_start = time.perf_counter()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.perf_counter()
+        self.n_batches = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.n_batches += 1
+        self.batch_end = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        epoch_time = self.batch_end - self.epoch_start
+        val_accuracy = (self.evaluate(self.model) if self.evaluate
+                        else (logs or {}).get("val_accuracy"))
+        row = {
+            "epoch": epoch + 1,
+            "wall_minutes": (time.perf_counter() - self.train_start) / 60,
+            "tokens_per_s": self.n_batches * self.tokens_per_batch
+                            / epoch_time,
+            "val_accuracy": val_accuracy,
+        }
+        self.rows.append(row)
+        print(f"\nepoch {row['epoch']}: {row['tokens_per_s']:,.0f} tokens/s, "
+              f"val_accuracy {val_accuracy:.4f} after "
+              f"{row['wall_minutes']:.1f} min")
+
+
+def stateless_evaluator(stateful_model, valid_set):
+    """Evaluates a stateful model's weights on `valid_set`.
+
+    The weights are copied into a stateless model of the same shape, so
+    validation does not disturb (or depend on) the training states.
+    """
+    model = build_model(*model_dims(stateful_model))
+
+    def evaluate(trained_model):
+        model.set_weights(trained_model.get_weights())
+        return model.evaluate(valid_set, verbose=0)[1]
+
+    return evaluate
+
+
+def train_stateful(train_text, valid_set, n_tokens, length=100, batch_size=32,
+                   epochs=10):
+    """Trains with non-overlapping windows; returns the model and the log.
+
+    The returned model is stateless, with the trained weights, so it can be
+    used anywhere the notebook's `model` is.
+    """
+    train_set = to_stateful_dataset(train_text, length, batch_size)
+    stateful_model = build_model(n_tokens, batch_size=batch_size,
+                                 stateful=True)
+    evaluate = stateless_evaluator(stateful_model, valid_set)
+    logger = TimeToAccuracy(batch_size * length, evaluate)
+    stateful_model.fit(train_set, epochs=epochs,
+                       callbacks=[ResetStatesCallback(), logger])
+    model = build_model(n_tokens)
+    model.set_weights(stateful_model.get_weights())
+    return model, logger.rows
+
+
+def train_baseline(train_text, valid_set, n_tokens, length=100, batch_size=32,
+                   epochs=10, pipeline=to_dataset):
+    """The notebook's `model.fit` setup, with the same logging."""
+    tf.random.set_seed(42)
+    train_set = pipeline(train_text, length=length, shuffle=True, seed=42,
+                         batch_size=batch_size)
+    model = build_model(n_tokens)
+    logger = TimeToAccuracy(batch_size * length)
+    model.fit(train_set, validation_data=valid_set, epochs=epochs,
+              callbacks=[logger])
+    return model, logger.rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=["stateful", "baseline", "fast"],
+                        default="stateful",
+                        help="'fast' is the baseline on to_dataset_fast")
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--length", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--log", help="write the per-epoch log to this JSON")
+    args = parser.parse_args(argv)
+
+    text_vec_layer, encoded = load_shakespeare()
+    n_tokens = text_vec_layer.vocabulary_size() - 2
+    valid_set = to_dataset_fast(encoded[1_000_000:1_060_000],
+                                length=args.length)
+    options = dict(length=args.length, batch_size=args.batch_size,
+                   epochs=args.epochs)
+    if args.mode == "stateful":
+        _, rows = train_stateful(encoded[:1_000_000], valid_set, n_tokens,
+                                 **options)
+    else:
+        pipeline = to_dataset if args.mode == "baseline" else to_dataset_fast
+        _, rows = train_baseline(encoded[:1_000_000], valid_set, n_tokens,
+                                 pipeline=pipeline, **options)
+    if args.log:
+        with open(args.log, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
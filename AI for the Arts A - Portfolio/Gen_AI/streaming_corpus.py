@@ -0,0 +1,207 @@
+"""Sharded, streaming corpora for training on text larger than RAM.
+
+The notebook reads shakespeare.txt into one string and encodes it with a
+single `text_vec_layer([...])` call, which cannot work for multi-GB author
+corpora. `build_shards` instead reads the text files in chunks, encodes each
+chunk with a `CharCodec` and appends it to fixed-size binary shard files
+(uint8 token IDs, or uint16 for vocabularies above 256 characters), with a
+`manifest.json` describing the vocabulary and the shards. `sharded_dataset`
+then feeds `model.fit` from the shards: shard files are read sequentially as
+fixed-length records of `length + 1` tokens, several shards are interleaved
+in parallel, and windows are shuffled in a bounded buffer, so memory use
+depends on the buffer sizes but not on the size of the corpus.
+
+    python streaming_corpus.py build corpus/*.txt --output shards
+    python streaming_corpus.py check shards  # windows move between epochs
+    train_set = sharded_dataset("shards", length=100, shuffle=True)
+    model.fit(train_set, epochs=10)
+
+Windows do not overlap (each epoch costs one GRU step per character, as in
+`stateful_training`); each shard starts at a random offset every epoch, so
+the window boundaries move from one epoch to the next.
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from char_codec import CharCodec
+
+chunk_chars = 1 << 20  # characters read and encoded at a time
+
+
+def _read_chunks(filepaths):
+    for filepath in filepaths:
+        with open(filepath, encoding="utf-8") as f:
+            for chunk in iter(lambda: f.read(chunk_chars), ""):
+                yield chunk
+
+
+def count_characters(filepaths):
+    """Streams through `filepaths` and returns the vocabulary.
+
+    Characters are lowercased like `standardize="lower"` (ASCII only) and
+    sorted by decreasing frequency.
+    """
+    counts = {}
+    for chunk in _read_chunks(filepaths):
+        code_points = np.frombuffer(chunk.encode("utf-32-le"), np.uint32)
+        upper = (code_points >= ord("A")) & (code_points <= ord("Z"))
+        code_points = np.where(upper, code_points + 32, code_points)
+        for code_point, count in zip(*np.unique(code_points,
+                                                return_counts=True)):
+            counts[int(code_point)] = counts.get(int(code_point), 0) + count
+    ranked = sorted(counts, key=lambda code_point: (-counts[code_point],
+                                                    code_point))
+    return [chr(code_point) for code_point in ranked]
+
+
+def build_shards(filepaths, output_dir, vocabulary=None,
+                 shard_tokens=64 * 2**20):
+    """Encodes the text files into shards of `shard_tokens` tokens.
+
+    If `vocabulary` is None it is computed with a first streaming pass; pass
+    `text_vec_layer.get_vocabulary()[2:]` instead to keep the IDs of the
+    notebook's model. Characters outside the vocabulary are dropped. Returns
+    the manifest, which is also saved in `output_dir`.
+    """
+    filepaths = list(filepaths)
+    if vocabulary is None:
+        vocabulary = count_characters(filepaths)
+    codec = CharCodec(vocabulary)
+    dtype = np.uint8 if len(codec) <= 256 else np.uint16
+    os.makedirs(output_dir, exist_ok=True)
+    shards, shard, shard_size = [], None, 0
+
+    def open_shard():
+        name = f"shard-{len(shards):05d}.bin"
+        shards.append({"file": name, "tokens": 0})
+        return open(os.path.join(output_dir, name), "wb")
+
+    try:
+        for chunk in _read_chunks(filepaths):
+            char_ids = codec.encode(chunk, skip_unknown=True).astype(dtype)
+            while char_ids.size:
+                if shard is None or shard_size == shard_tokens:
+                    if shard is not None:
+                        shard.close()
+                    shard, shard_size = open_shard(), 0
+                part = char_ids[:shard_tokens - shard_size]
+                shard.write(part.tobytes())
+                shard_size += part.size
+                shards[-1]["tokens"] += part.size
+                char_ids = char_ids[part.size:]
+    finally:
+        if shard is not None:
+            shard.close()
+    manifest = {"vocabulary": codec.vocabulary,
+                "dtype": np.dtype(dtype).name, "shards": shards,
+                "tokens": sum(shard["tokens"] for shard in shards)}
+    with open(os.path.join(output_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def load_manifest(shard_dir):
+    with open(os.path.join(shard_dir, "manifest.json")) as f:
+        return json.load(f)
+
+
+def sharded_dataset(shard_dir, length, shuffle=False, seed=None,
+                    batch_size=32, shuffle_buffer_size=10_000,
+                    cycle_length=4):
+    """(X, Y) batches of non-overlapping windows streamed from the shards.
+
+    At most `cycle_length` shards are read at once, and at most
+    `shuffle_buffer_size` windows are held for shuffling.
+    """
+    manifest = load_manifest(shard_dir)
+    dtype = tf.as_dtype(manifest["dtype"])
+    token_bytes = dtype.size
+    record_bytes = (length + 1) * token_bytes
+    filenames = [os.path.join(shard_dir, shard["file"])
+                 for shard in manifest["shards"]]
+    if shuffle:
+        # a new offset per shard at every epoch: an op-seeded RNG in the
+        # interleave function would restart with `seed` at every epoch
+        offsets = tf.data.Dataset.random(
+            seed=seed, rerandomize_each_iteration=True).map(
+                lambda value: value % (length + 1))
+    else:
+        offsets = tf.data.Dataset.from_tensors(tf.constant(0, tf.int64))
+    ds = tf.data.Dataset.zip((tf.data.Dataset.from_tensor_slices(filenames),
+                              offsets.repeat()))
+    if shuffle:
+        ds = ds.shuffle(len(filenames), seed=seed)
+
+    def read_windows(filename, offset):
+        return tf.data.FixedLengthRecordDataset(
+            filename, record_bytes, header_bytes=offset * token_bytes)
+
+    ds = ds.interleave(read_windows, cycle_length=cycle_length,
+                       num_parallel_calls=tf.data.AUTOTUNE,
+                       deterministic=not shuffle)
+    if shuffle:
+        ds = ds.shuffle(shuffle_buffer_size, seed=seed)
+    ds = ds.batch(batch_size)
+
+    def to_inputs_and_targets(records):
+        window = tf.cast(tf.io.decode_raw(records, dtype), tf.int32)
+        return window[:, :-1], window[:, 1:]
+
+    ds = ds.map(to_inputs_and_targets, num_parallel_calls=tf.data.AUTOTUNE)
+    return ds.prefetch(tf.data.AUTOTUNE)
+
+
+def epochs_differ(shard_dir, length=100, seed=42, epochs=5):
+    """Whether the iterations of a shuffled `sharded_dataset` start with
+    different windows, as they should since the offsets move.
+
+    An offset repeats with probability 1 / (length + 1), so several epochs
+    are compared.
+    """
+    ds = sharded_dataset(shard_dir, length, shuffle=True, seed=seed,
+                         shuffle_buffer_size=1, cycle_length=1)
+    first_windows = {next(iter(ds))[0][0].numpy().tobytes()
+                     for _ in range(epochs)}
+    return len(first_windows) > 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build")
+    build_parser.add_argument("files", nargs="+")
+    build_parser.add_argument("--output", required=True)
+    build_parser.add_argument("--shard-mb", type=int, default=64)
+    build_parser.add_argument(
+        "--shakespeare-vocabulary", action="store_true",
+        help="use the notebook's vocabulary, so my_shakespeare_model applies")
+    check_parser = subparsers.add_parser(
+        "check", help="check that the windows change from epoch to epoch")
+    check_parser.add_argument("shard_dir")
+    check_parser.add_argument("--length", type=int, default=100)
+    args = parser.parse_args(argv)
+
+    if args.command == "check":
+        if not epochs_differ(args.shard_dir, args.length):
+            raise SystemExit("every epoch started with the same window")
+        print("the epochs started with different windows")
+        return
+    vocabulary = None
+    if args.shakespeare_vocabulary:
+        from text_datasets import load_shakespeare
+
+        text_vec_layer, _ = load_shakespeare()
+        vocabulary = text_vec_layer.get_vocabulary()[2:]
+    manifest = build_shards(args.files, args.output, vocabulary,
+                            args.shard_mb * 2**20)
+    print(f"{manifest['tokens']:,} tokens in {len(manifest['shards'])} "
+          f"shards, {len(manifest['vocabulary'])} distinct characters")
+
+
+if __name__ == "__main__":
+    main()
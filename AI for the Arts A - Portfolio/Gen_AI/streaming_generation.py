@@ -0,0 +1,195 @@
+"""Incremental text generation: characters are handed over as soon as sampled.
+
+`extend_text` and `StatefulGenerator.generate` return only after all
+`n_chars` characters exist, so an interactive caller waits for the whole
+string. A `GenerationStream` runs one GRU step (and one sample) each time
+the caller asks for more, and yields every `chunk_size` characters as they
+are produced. It is both an iterator and an async iterator; in the async
+form, each step runs on a worker thread so the event loop stays responsive.
+
+Generation stops, before the next GRU step, when `n_chars` characters have
+been produced, when `cancel()` is called (or the consuming task is
+cancelled, or the stream is closed), or when `timeout` seconds have passed
+since the stream was created. `stop_reason` tells which. No work is done
+ahead of the caller, so a stream that is abandoned costs nothing more.
+
+    stream = GenerationStream(generator, "To be, or not to be", n_chars=200,
+                              timeout=2.0)
+    for chunk in stream:
+        print(chunk, end="", flush=True)
+    stream.metrics()  # time to first character, inter-character latency
+
+    async for chunk in GenerationStream(generator, prompt):
+        await websocket.send(chunk)
+
+    python streaming_generation.py --n-chars 200 --timeout 1
+"""
+
+import argparse
+import asyncio
+import statistics
+import threading
+import time
+
+import tensorflow as tf
+
+
+class GenerationStream:
+    """Streams the extension of `prompt` by a `StatefulGenerator`."""
+
+    def __init__(self, generator, prompt, n_chars=50, temperature=1,
+                 chunk_size=1, timeout=None, executor=None):
+        generator.encode(prompt)  # fail fast on unusable prompts
+        self.generator = generator
+        self.prompt = prompt
+        self.n_chars = n_chars
+        self.chunk_size = chunk_size
+        self.executor = executor  # for async iteration; None: the default
+        self.created = time.perf_counter()
+        self.deadline = None if timeout is None else self.created + timeout
+        self.options = {"temperature": tf.constant([temperature],
+                                                   tf.float32),
+                        "top_k": tf.constant(0), "top_p": tf.constant(1.0),
+                        "repetition_penalty": tf.constant(1.0)}
+        self.cancelled = threading.Event()
+        self.generated = []
+        self.sample_times = []  # one per character
+        self.delivery_times = []  # one per chunk
+        self.stop_reason = None
+        self._probas = self._state = self._counts = None
+
+    @property
+    def text(self):
+        """The prompt and every character generated so far."""
+        return self.prompt + "".join(self.generated)
+
+    def cancel(self, reason="cancelled"):
+        if self.stop_reason is None:
+            self.stop_reason = reason
+        self.cancelled.set()
+
+    def close(self):
+        self.cancel("closed")
+
+    def _should_stop(self):
+        if self.cancelled.is_set():
+            return True
+        if len(self.generated) >= self.n_chars:
+            self.stop_reason = "completed"
+        elif (self.deadline is not None
+              and time.perf_counter() >= self.deadline):
+            self.stop_reason = "deadline"
+        return self.stop_reason is not None
+
+    def _next_char(self):
+        """Runs one GRU step; returns the new character, or None if done."""
+        if self._should_stop():
+            return None
+        if self._state is None:
+            self._probas, self._state = self.generator.feed(
+                self.generator.encode(self.prompt)[tf.newaxis])
+            self._counts = tf.zeros([1, len(self.generator.codec)], tf.int32)
+            if self._should_stop():  # the prompt may have used up the time
+                return None
+        char_ids, self._probas, self._state, self._counts = (
+            self.generator.sample_and_step(self._probas, self._state,
+                                           self._counts, self.options))
+        char = self.generator.decode(char_ids)
+        self.generated.append(char)
+        self.sample_times.append(time.perf_counter())
+        return char
+
+    def _next_chunk(self):
+        chunk = []
+        while len(chunk) < self.chunk_size:
+            char = self._next_char()
+            if char is None:
+                break
+            chunk.append(char)
+        if not chunk:
+            return None
+        self.delivery_times.append(time.perf_counter())
+        return "".join(chunk)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = self._next_chunk()
+        if chunk is None:
+            raise StopIteration
+        return chunk
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        loop = asyncio.get_running_loop()
+        try:
+            chunk = await loop.run_in_executor(self.executor,
+                                               self._next_chunk)
+        except asyncio.CancelledError:
+            self.cancel()  # the step in flight finishes, no other starts
+            raise
+        if chunk is None:
+            raise StopAsyncIteration
+        return chunk
+
+    def metrics(self):
+        """Latencies in milliseconds.
+
+        The time to the first character is measured at its delivery to the
+        caller; the gaps between characters when they are sampled, and the
+        gaps between chunks when they are delivered.
+        """
+        metrics = {"chars": len(self.generated),
+                   "chunks": len(self.delivery_times),
+                   "stop_reason": self.stop_reason,
+                   "time_to_first_char_ms": None,
+                   "inter_char_ms": _gap_summary(self.sample_times),
+                   "inter_chunk_ms": _gap_summary(self.delivery_times)}
+        if self.delivery_times:
+            metrics["time_to_first_char_ms"] = (
+                (self.delivery_times[0] - self.created) * 1e3)
+        return metrics
+
+
+def _gap_summary(times):
+    """Mean, p50, p95 and max of the gaps between `times`, in milliseconds."""
+    gaps = [(later - earlier) * 1e3 for earlier, later
+            in zip(times, times[1:])]
+    if not gaps:
+        return None
+    return {"mean": statistics.mean(gaps), "p50": statistics.median(gaps),
+            "p95": sorted(gaps)[int(0.95 * (len(gaps) - 1))],
+            "max": max(gaps)}
+
+
+def main(argv=None):
+    from text_datasets import load_shakespeare
+    from text_generation import StatefulGenerator
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model-dir", default="my_shakespeare_model")
+    parser.add_argument("--prompt", default="To be, or not to be")
+    parser.add_argument("--n-chars", type=int, default=200)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--timeout", type=float)
+    args = parser.parse_args(argv)
+
+    text_vec_layer, _ = load_shakespeare()
+    model = tf.keras.models.load_model(args.model_dir)
+    generator = StatefulGenerator(model, text_vec_layer)
+    for _ in GenerationStream(generator, args.prompt, n_chars=2):
+        pass  # trace
+    stream = GenerationStream(generator, args.prompt, args.n_chars,
+                              args.temperature, timeout=args.timeout)
+    print(args.prompt, end="", flush=True)
+    for chunk in stream:
+        print(chunk, end="", flush=True)
+    print()
+    print(stream.metrics())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""Stateful text generation for the Shakespeare char-RNN.
+
+The notebook's `next_char` calls `shakespeare_model.predict()` on the whole
+text generated so far, so every new character re-runs the GRU over the entire
+prefix. Here the prompt goes through the GRU once, the recurrent hidden state
+is kept, and each new character is fed in on its own: generating `n_chars`
+characters costs `len(text) + n_chars` GRU steps instead of roughly
+`n_chars * len(text)`.
+
+Usage, after training `model` and adapting `text_vec_layer` in the notebook
+(or loading `model` back with `tf.keras.models.load_model("my_shakespeare_model")`):
+
+    generator = StatefulGenerator(model, text_vec_layer)
+    print(generator.extend_text("To be, or not to be", temperature=0.01))
+
+`StatefulGenerator.generate` does the same for many prompts at once, with a
+temperature and an optional seed per row, advancing every row together with a
+single batched GRU step per generated character:
+
+    prompts = ["To be, or not to be", "The lady doth protest too much"]
+    texts = generator.generate(prompts * 3, temperatures=[0.01] * 2 + [1] * 2
+                               + [100] * 2, seeds=range(6))
+"""
+
+import tensorflow as tf
+
+from char_codec import as_codec
+from sampling import sample
+
+
+def make_step_model(model):
+    """Rebuild the trained `model` so that it takes and returns the GRU state.
+
+    The returned model maps `[char_ids, state]` to `[probas, new_state]`. It
+    shares the trained Embedding and Dense layers with `model` and uses a copy
+    of its GRU layer with `return_state=True`.
+    """
+    embedding, gru, dense = model.layers
+    step_gru = tf.keras.layers.GRU.from_config(
+        {**gru.get_config(), "return_state": True, "name": "step_gru"})
+    char_ids = tf.keras.Input(shape=[None], dtype=tf.int32)
+    state = tf.keras.Input(shape=[gru.units])
+    Z = embedding(char_ids)
+    Z, new_state = step_gru(Z, initial_state=state)
+    step_gru.set_weights(gru.get_weights())
+    return tf.keras.Model([char_ids, state], [dense(Z), new_state])
+
+
+def make_shakespeare_model(model, text_vec_layer):
+    """The notebook's `shakespeare_model`: raw text in, probabilities out."""
+    return tf.keras.Sequential([
+        text_vec_layer,
+        tf.keras.layers.Lambda(lambda X: X - 2),  # no <PAD> or <UNK> tokens
+        model
+    ])
+
+
+def reference_extend_text(shakespeare_model, text_vec_layer, text, n_chars=50,
+                          temperature=1):
+    """The notebook's `next_char`/`extend_text` loop, kept for comparison."""
+    for _ in range(n_chars):
+        y_proba = shakespeare_model.predict([text], verbose=0)[0, -1:]
+        rescaled_logits = tf.math.log(y_proba) / temperature
+        char_id = tf.random.categorical(rescaled_logits, num_samples=1)[0, 0]
+        text += text_vec_layer.get_vocabulary()[char_id + 2]
+    return text
+
+
+class StatefulGenerator:
+    """Generates text one GRU step per character, carrying the hidden state.
+
+    `text_vec_layer` may also be a subword tokenizer such as
+    `bpe_tokenizer.BPETokenizer`, for a model trained on its token IDs; the
+    steps, and `n_chars`, then count tokens rather than characters.
+    """
+
+    def __init__(self, model, text_vec_layer):
+        self.step_model = make_step_model(model)
+        self.codec = as_codec(text_vec_layer)
+        self.units = self.step_model.inputs[1].shape[-1]
+        self._step = tf.function(
+            lambda char_ids, state: self.step_model([char_ids, state]),
+            input_signature=[tf.TensorSpec([None, None], tf.int32),
+                             tf.TensorSpec([None, self.units], tf.float32)])
+        self.sample_and_step = tf.function(self.sample_and_step,
+                                           reduce_retracing=True)
+
+    def initial_state(self, batch_size=1):
+        return tf.zeros([batch_size, self.units])
+
+    def encode(self, text):
+        char_ids = self.codec.encode(text)
+        if char_ids.size == 0:
+            raise ValueError("text must contain at least one character")
+        return char_ids
+
+    def encode_batch(self, prompts):
+        """Encodes a list of prompts, padded with -2 (the shifted pad token).
+
+        Returns the padded IDs, shape [batch, max_length], and the length of
+        each prompt as a list of ints.
+        """
+        char_ids, lengths = self.codec.encode_batch(prompts)
+        if min(lengths, default=0) == 0:
+            raise ValueError("every prompt must contain at least one character")
+        return char_ids, lengths
+
+    def decode(self, char_ids):
+        return self.codec.decode(tf.convert_to_tensor(char_ids).numpy())
+
+    def decode_batch(self, char_ids):
+        return self.codec.decode_batch(tf.convert_to_tensor(char_ids).numpy())
+
+    def feed(self, char_ids, state=None):
+        """Runs the GRU over `char_ids` (shape [batch, steps]) from `state`.
+
+        Returns the next-character probabilities and the updated state.
+        """
+        if state is None:
+            state = self.initial_state(tf.shape(char_ids)[0])
+        probas, state = self._step(char_ids, state)
+        return probas[:, -1], state
+
+    def extend_text(self, text, n_chars=50, temperature=1):
+        """Same contract as the notebook's `extend_text`, in O(n) GRU steps."""
+        probas, state = self.feed(self.encode(text)[tf.newaxis])
+        generated = []
+        for _ in range(n_chars):
+            rescaled_logits = tf.math.log(probas) / temperature
+            char_id = tf.random.categorical(rescaled_logits, num_samples=1,
+                                            dtype=tf.int32)
+            generated.append(char_id[0, 0])
+            probas, state = self.feed(char_id, state)
+        return text + self.decode(tf.stack(generated)) if generated else text
+
+    def feed_prompts(self, char_ids, lengths):
+        """Runs padded prompts through the GRU, bucketed by length.
+
+        Prompts of the same length go through the GRU together, so no row ever
+        sees padding. Returns the next-character probabilities and the states
+        in the original prompt order.
+        """
+        rows, probas, states = [], [], []
+        for length in sorted(set(lengths)):
+            bucket = [row for row, n in enumerate(lengths) if n == length]
+            bucket_probas, bucket_state = self.feed(
+                char_ids[bucket, :length])
+            rows.extend(bucket)
+            probas.append(bucket_probas)
+            states.append(bucket_state)
+        inverse = tf.math.invert_permutation(rows)
+        return (tf.gather(tf.concat(probas, axis=0), inverse),
+                tf.gather(tf.concat(states, axis=0), inverse))
+
+    def sample_and_step(self, probas, state, counts, options,
+                        row_seeds=None):
+        """Samples one character per row, then feeds it to the GRU.
+
+        `options` holds the keyword arguments of `sampling.sample`, and
+        `counts` the number of times each row generated each character.
+        Returns the characters and the updated probabilities, state and
+        counts.
+        """
+        char_ids = sample(tf.math.log(probas), counts=counts,
+                          row_seeds=row_seeds, **options)
+        counts += tf.one_hot(char_ids, tf.shape(counts)[-1], dtype=tf.int32)
+        probas, state = self.step_model([char_ids[:, tf.newaxis], state])
+        return char_ids, probas[:, -1], state, counts
+
+    def generate(self, prompts, n_chars=50, temperatures=1, seeds=None,
+                 top_k=0, top_p=1.0, repetition_penalty=1.0,
+                 prompt_states=None):
+        """Extends every prompt in `prompts` by `n_chars` characters.
+
+        `temperatures` is either a single number or one per prompt. `seeds`
+        is either None (use TensorFlow's global seed) or one int per prompt,
+        in which case each row's output only depends on its own prompt,
+        temperature and seed, not on the rest of the batch. `top_k`, `top_p`
+        and `repetition_penalty` (see `sampling.sample`) may also be given
+        per prompt; the penalty applies to characters generated so far.
+        `prompt_states`, if given, is the `(probas, state)` pair that
+        `feed_prompts` would return for `prompts`, e.g. from a prefix cache.
+
+        Returns the list of extended prompts.
+        """
+        prompts = list(prompts)
+        if not prompts:
+            return []
+        temperatures = tf.broadcast_to(
+            tf.constant(temperatures, tf.float32), [len(prompts)])
+        if seeds is not None:
+            seeds = tf.constant(list(seeds), tf.int64)
+            if seeds.shape != [len(prompts)]:
+                raise ValueError("seeds must contain one seed per prompt")
+        options = {"temperature": temperatures,
+                   "top_k": tf.constant(top_k, tf.int32),
+                   "top_p": tf.constant(top_p, tf.float32),
+                   "repetition_penalty": tf.constant(repetition_penalty,
+                                                     tf.float32)}
+        if prompt_states is None:
+            prompt_states = self.feed_prompts(*self.encode_batch(prompts))
+        probas, state = prompt_states
+        counts = tf.zeros([len(prompts), len(self.codec)], tf.int32)
+        generated = []
+        for step in range(n_chars):
+            row_seeds = None if seeds is None else tf.stack(
+                [seeds, tf.fill(tf.shape(seeds), tf.constant(step, tf.int64))],
+                axis=1)
+            char_ids, probas, state, counts = self.sample_and_step(
+                probas, state, counts, options, row_seeds)
+            generated.append(char_ids)
+        if not generated:
+            return prompts
+        return [prompt + text for prompt, text in
+                zip(prompts, self.decode_batch(tf.stack(generated, axis=1)))]